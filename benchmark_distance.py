@@ -0,0 +1,80 @@
+# 
+# This file is part of the Health Behavior in Space software (https://github.com/dsalvolab/hbspace).
+# Copyright (c) 2022 Umberto Villa.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Throughput and accuracy of the distance backends.
+
+Usage: python benchmark_distance.py [gps_file.csv]
+
+Errors are measured against Karney's geodesics (geographiclib) over the distance
+ranges used by the pipeline. If a GPS file is given, consecutive fixes of that
+file are also used as a test set.
+"""
+
+from hbspace import *
+from geographiclib.geodesic import Geodesic
+
+import os
+import sys
+import time
+
+def random_pairs(npairs, min_dist, max_dist, center=(30.28, -97.74), spread=.5, seed=0):
+    rng = np.random.RandomState(seed)
+    lat1 = center[0] + spread*(rng.rand(npairs) - .5)
+    lon1 = center[1] + spread*(rng.rand(npairs) - .5)
+    dist = np.exp( rng.uniform(np.log(min_dist), np.log(max_dist), npairs) )
+    azi  = rng.uniform(-180., 180., npairs)
+    lat2 = np.zeros(npairs)
+    lon2 = np.zeros(npairs)
+    for i in range(npairs):
+        out = Geodesic.WGS84.Direct(lat1[i], lon1[i], azi[i], dist[i])
+        lat2[i], lon2[i] = out['lat2'], out['lon2']
+    return lat1, lon1, lat2, lon2, dist
+
+def gps_pairs(fname):
+    raw = RawGPSData(fname)
+    lat1, lon1 = raw.latitudes[:-1], raw.longitudes[:-1]
+    lat2, lon2 = raw.latitudes[1:], raw.longitudes[1:]
+    dist = np.array([Geodesic.WGS84.Inverse(*p)['s12'] for p in zip(lat1, lon1, lat2, lon2)])
+    return lat1, lon1, lat2, lon2, dist
+
+def benchmark(g, lat1, lon1, lat2, lon2, dist, nrepeat=3):
+    elapsed = np.inf
+    for _ in range(nrepeat):
+        start = time.time()
+        d = g.compute_distances(lat1, lon1, lat2, lon2)
+        elapsed = min(elapsed, time.time() - start)
+    err = np.abs(d - dist)
+    return lat1.shape[0]/elapsed, err.max(), np.max( err/np.maximum(dist, 1e-3) )
+
+if __name__ == '__main__':
+    
+    test_sets = [("1-10 m",      random_pairs(20000,    1.,   10.) ),
+                 ("10-100 m",    random_pairs(20000,   10.,  100.) ),
+                 ("100-1000 m",  random_pairs(20000,  100., 1000.) ),
+                 ("1-5 km",      random_pairs(20000, 1000., 5000.) )]
+    
+    if len(sys.argv) > 1:
+        test_sets.append( (os.path.basename(sys.argv[1]), gps_pairs(sys.argv[1])) )
+        
+    print("{0:<24}{1:<16}{2:>16}{3:>16}{4:>16}".format("Range", "Backend", "Pairs/s", "Max err (m)", "Max rel err"))
+    for name, pairs in test_sets:
+        for backend in sorted(distanceBackends.keys()):
+            g = GeodesicDistance(backend)
+            throughput, max_err, max_rel_err = benchmark(g, *pairs)
+            print("{0:<24}{1:<16}{2:>16.3e}{3:>16.3e}{4:>16.3e}".format(name, backend, throughput, max_err, max_rel_err))
@@ -29,7 +29,12 @@ if __name__ == '__main__':
     
     folder_out = "data/out"
     
+    cache = RawGPSCache("data/cache")
+    
     parameters = defaultParameters()
+    distance = GeodesicDistance(parameters["distance"]["backend"])
+    
+    executor = segmentExecutor(parameters["trip"])
     
     invalid_fixes_ratio = np.zeros(len(fnames))
     lone_fixes           = np.zeros(len(fnames))
@@ -48,6 +53,11 @@ if __name__ == '__main__':
     summary = csv.DictWriter(summary_fid, trip_stats_headers())
     summary.writeheader()
     
+    filter_fname = "filter_stats.csv"
+    filter_fid = open(filter_fname, "w", newline='')
+    filter_out = csv.DictWriter(filter_fid, filter_stats_headers())
+    filter_out.writeheader()
+    
     trips_fname = "trips_long.csv"
     trips_fid   = open(trips_fname, "w", newline='')
     trips_out       = csv.DictWriter(trips_fid, Trip.infoKeys())
@@ -69,15 +79,17 @@ if __name__ == '__main__':
          
     for fname in fnames:
         print(fname)
-        rawdata = RawGPSData(fname)
+        rawdata = RawGPSData(fname, cache=cache, distance=distance,
+                             project=parameters["distance"]["project"])
                 
         print("Data ", rawdata.id)
         data = rawdata.getCleanData(parameters["invalid_fixes"])
+        filter_out.writerow(rawdata.filter_stats())
         data.tripCounter     = tripCounter
         data.locationCounter = locationCounter
         data.visitCounter    = visitCounter
         print("Total fix {0}, Valid fix {1}".format(rawdata.is_valid.shape[0], np.sum(rawdata.is_valid==1)))
-        data.trip_detection(parameters["trip"])
+        data.trip_detection(parameters["trip"], executor)
         data.classify_trip(parameters["speed"])
         data.location_detection(parameters["location"])
         #data.proj = proj
@@ -111,10 +123,10 @@ if __name__ == '__main__':
         print("First fixes", first_fixes[counter])
         print("UnassignedFixes: ", unassignedFixes, "Ratio: ", unassignedFixes_ratio)
         if(len(data.visits)):
-            print("Max radius location: ", max([v.radius for v in data.visits]))
+            print("Max radius location: ", np.max(data.visits.column("radius")))
         if(len(data.trips)):
-            print("Min trip duration: ", min([t.duration for t in data.trips]))
-            print("Min trip distance traveled: ", min([t.distance for t in data.trips]))
+            print("Min trip duration: ", np.min(data.trips.column("duration")))
+            print("Min trip distance traveled: ", np.min(data.trips.column("distance")))
         print("\n")
         counter+=1
         
@@ -126,7 +138,10 @@ if __name__ == '__main__':
     print("Minimum and maximum valid time (hours)", valid_hours.min(), valid_hours.max())
     print("Minimum and maximum SLOSS ratio", (sloss_hours/tot_hours).min(), (sloss_hours/tot_hours).max())
     
+    if executor is not None:
+        executor.shutdown()
     summary_fid.close()
+    filter_fid.close()
     trips_fid.close()
     locations_fid.close()
 
@@ -24,6 +24,14 @@ if __name__ == '__main__':
     
     home_addresses = homeAddresses('data/FRESH_HomeAddress_XY.csv')
     store_addresses = storeAddresses('data/FRESH_FoodStores_XY.csv')
+    store_index = StoreIndex(store_addresses)
+    
+    # Optional geofence layers (parks, schools, ...)
+    geofence_fname = 'data/Geofences.csv'
+    geofence_layers = []
+    if os.path.exists(geofence_fname):
+        geofence_layers = [GeofenceLayer(name, places) for name, places in geofenceAddresses(geofence_fname).items()]
+    geofence_names = [layer.name for layer in geofence_layers]
     
     folder = "data/GPS"
     fnames =  [os.path.join(folder, f) for f in os.listdir(folder) if os.path.splitext( f )[1] == ".csv"]
@@ -32,7 +40,12 @@ if __name__ == '__main__':
     
     folder_out = "data/out"
     
+    cache = RawGPSCache("data/cache")
+    
     parameters = defaultParameters()
+    distance = GeodesicDistance(parameters["distance"]["backend"])
+    
+    executor = segmentExecutor(parameters["trip"])
     
     invalid_fixes_ratio = np.zeros(len(fnames))
     lone_fixes           = np.zeros(len(fnames))
@@ -48,12 +61,17 @@ if __name__ == '__main__':
     
     summary_fname = "summary.csv"
     summary_fid = open(summary_fname, "w", newline='')
-    summary = csv.DictWriter(summary_fid, trip_stats_headers())
+    summary = csv.DictWriter(summary_fid, trip_stats_headers(geofence_names))
     summary.writeheader()
     
+    filter_fname = "filter_stats.csv"
+    filter_fid = open(filter_fname, "w", newline='')
+    filter_out = csv.DictWriter(filter_fid, filter_stats_headers())
+    filter_out.writeheader()
+    
     trips_fname = "trips_long.csv"
     trips_fid   = open(trips_fname, "w", newline='')
-    trips_out       = csv.DictWriter(trips_fid, Trip.infoKeysExt())
+    trips_out       = csv.DictWriter(trips_fid, Trip.infoKeysExt(geofence_names))
     trips_out.writeheader()
     
     locations_fname = "locations_long.csv"
@@ -63,7 +81,7 @@ if __name__ == '__main__':
     
     visit_fname = "visits_long.csv"
     visit_fid   = open(visit_fname, "w", newline='')
-    visit_out       = csv.DictWriter(visit_fid, Visit.infoKeysExt())
+    visit_out       = csv.DictWriter(visit_fid, Visit.infoKeysExt(geofence_names))
     visit_out.writeheader()
     
     tripCounter     = 0
@@ -75,18 +93,21 @@ if __name__ == '__main__':
         
         partId = filename2partId(fname)
         
-        rawdata = RawGPSData(fname)
+        rawdata = RawGPSData(fname, cache=cache, distance=distance,
+                             project=parameters["distance"]["project"])
                 
         print("Data ", rawdata.id)
         data = rawdata.getCleanData(parameters["invalid_fixes"])
+        filter_out.writerow(rawdata.filter_stats())
         data.tripCounter     = tripCounter
         data.locationCounter = locationCounter
         data.visitCounter    = visitCounter
         print("Total fix {0}, Valid fix {1}".format(rawdata.is_valid.shape[0], np.sum(rawdata.is_valid==1)))
         data.id = partId
         data.mark_home(home_addresses[partId], radius=50)
-        data.mark_store(store_addresses, radius=50)
-        data.trip_detection(parameters["trip"])
+        data.mark_store(store_addresses, radius=50, index=store_index)
+        data.mark_geofences(geofence_layers)
+        data.trip_detection(parameters["trip"], executor)
         data.classify_trip(parameters["speed"])
         data.location_detection(parameters["location"])
         #data.proj = proj
@@ -120,10 +141,10 @@ if __name__ == '__main__':
         print("First fixes", first_fixes[counter])
         print("UnassignedFixes: ", unassignedFixes, "Ratio: ", unassignedFixes_ratio)
         if(len(data.visits)):
-            print("Max radius location: ", max([v.radius for v in data.visits]))
+            print("Max radius location: ", np.max(data.visits.column("radius")))
         if(len(data.trips)):
-            print("Min trip duration: ", min([t.duration for t in data.trips]))
-            print("Min trip distance traveled: ", min([t.distance for t in data.trips]))
+            print("Min trip duration: ", np.min(data.trips.column("duration")))
+            print("Min trip distance traveled: ", np.min(data.trips.column("distance")))
         print("\n")
         counter+=1
         
@@ -135,7 +156,10 @@ if __name__ == '__main__':
     print("Minimum and maximum valid time (hours)", valid_hours.min(), valid_hours.max())
     print("Minimum and maximum SLOSS ratio", (sloss_hours/tot_hours).min(), (sloss_hours/tot_hours).max())
     
+    if executor is not None:
+        executor.shutdown()
     summary_fid.close()
+    filter_fid.close()
     trips_fid.close()
     locations_fid.close()
 
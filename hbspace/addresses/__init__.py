@@ -16,4 +16,5 @@
 #
 
 from .home_addresses import filename2partId, homeAddresses
-from .stores_addresses import storeAddresses
\ No newline at end of file
+from .stores_addresses import storeAddresses
+from .geofences import geofenceAddresses
\ No newline at end of file
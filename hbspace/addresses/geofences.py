@@ -0,0 +1,52 @@
+# 
+# This file is part of the Health Behavior in Space software (https://github.com/dsalvolab/hbspace).
+# Copyright (c) 2022 Umberto Villa.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import csv
+import os
+
+def geofenceAddresses(fname):
+    """
+    Places of the geofence layers: layer -> {place_id -> shape} (see GeofenceLayer).
+    Columns: LAYER (optional, defaults to the file name), PLACE_ID, X, Y and RADIUS (optional).
+    A row with a RADIUS is a circle; the rows of a place without RADIUS are the vertices
+    of a polygon, in the order they appear in the file (they need not be consecutive).
+    A place is either a single circle row or only vertex rows.
+    """
+    default_layer = os.path.splitext(os.path.basename(fname))[0]
+    layers = {}
+    with open(fname, 'r') as fid:
+        reader = csv.DictReader(fid)
+        for row in reader:
+            layer     = row.get('LAYER') or default_layer
+            placeId   = int(row['PLACE_ID'])
+            latitude  = float(row['Y'])
+            longitude = float(row['X'])
+            radius    = row.get('RADIUS')
+            places = layers.setdefault(layer, {})
+            shape  = places.get(placeId)
+            if radius:
+                if shape is not None:
+                    raise ValueError("{0}, line {1}: place {2} of layer {3} is already defined, a circle must be a single row".format(
+                                     fname, reader.line_num, placeId, layer))
+                places[placeId] = (latitude, longitude, float(radius))
+            else:
+                if isinstance(shape, tuple):
+                    raise ValueError("{0}, line {1}: place {2} of layer {3} is a circle, it cannot have polygon vertices".format(
+                                     fname, reader.line_num, placeId, layer))
+                places.setdefault(placeId, []).append( (latitude, longitude) )
+        
+    return layers
@@ -17,6 +17,27 @@
 
 import csv
 import os
+from datetime import datetime
+import numpy as np
+from ..gps.rawGpsData import DATETIME_FORMATS
+
+# Formats of the START/END columns: ISO and the formats of the GPS files, with or without time
+PERIOD_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d") + DATETIME_FORMATS + \
+                 tuple(fmt.split(" ")[0] for fmt in DATETIME_FORMATS)
+
+def parsePeriodBound(value):
+    """
+    Convert a START/END value (see PERIOD_FORMATS) to numpy.datetime64, None if empty
+    """
+    value = value.strip() if value else ""
+    if not value:
+        return None
+    for fmt in PERIOD_FORMATS:
+        try:
+            return np.datetime64(datetime.strptime(value, fmt), 's')
+        except ValueError:
+            pass
+    raise ValueError("Unrecognized date {0!r}, expected one of the formats {1}".format(value, PERIOD_FORMATS))
 
 def filename2partId(fname):
     base = os.path.basename(fname)
@@ -24,13 +45,29 @@ def filename2partId(fname):
     return partId
 
 def homeAddresses(fname):
+    """
+    Home address of each participant: FRESHID -> (latitude, longitude).
+    If the file has START and/or END columns (date or date and time in one of PERIOD_FORMATS,
+    e.g. 2021-03-05 or 03/05/2021, empty for an open end) a participant can have several rows
+    (e.g. after a move), and the value is the list of home periods (latitude, longitude, start, end)
+    with start and end as numpy.datetime64 or None, start included and end excluded.
+    """
     home_addresses = {}
     with open(fname, 'r') as fid:
         reader = csv.DictReader(fid)
+        periods = 'START' in reader.fieldnames or 'END' in reader.fieldnames
         for row in reader:
             partId    = int(row['FRESHID'])
             latitude  = float(row['Y'])
             longitude = float(row['X'])
-            home_addresses[partId] = (latitude, longitude)
+            if periods:
+                try:
+                    start = parsePeriodBound(row.get('START'))
+                    end   = parsePeriodBound(row.get('END'))
+                except ValueError as e:
+                    raise ValueError("{0}, line {1}: {2}".format(fname, reader.line_num, e))
+                home_addresses.setdefault(partId, []).append( (latitude, longitude, start, end) )
+            else:
+                home_addresses[partId] = (latitude, longitude)
         
     return home_addresses
\ No newline at end of file
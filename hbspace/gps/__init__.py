@@ -15,17 +15,21 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-from .gpsData import GPSData
-from .trip import Trip
-from .location import Visit, Location
+from .gpsData import GPSData, segmentExecutor
+from .trip import Trip, TripTable
+from .location import Visit, Location, VisitTable, LocationTable
 from .rawGpsData import RawGPSData
+from .rawGpsCache import RawGPSCache
+from .storeIndex import StoreIndex
+from .geofence import GeofenceLayer
 
 from .parameter import invalidFixesDefaults, \
                        locationDetectionDefaults, \
                        tripDetectionDefaults, \
                        speedCutoffDefaults, \
+                       distanceDefaults, \
                        defaultParameters
                        
-from .distance import GeodesicDistance
+from .distance import GeodesicDistance, distanceBackends
 
 #from .projection import  UTMprojection
@@ -42,30 +42,73 @@ try:
 except:
     has_pyproj = False
 
+    
+class GeodesicDistanceBase:
+    """
+    Array-in/array-out distance API shared by all the distance backends.
+    Subclasses implement compute_distances on arrays of coordinates (degrees);
+    all distances are in meters.
+    """
+    
+    def compute_distance(self, lat1, lon1, lat2, lon2):
+        return self.compute_distances(np.array([lat1]), np.array([lon1]),
+                                      np.array([lat2]), np.array([lon2]))[0]
+    
+    def compute_distance_t(self, coords1, coords2):
+        return self.compute_distance(coords1[0], coords1[1], coords2[0], coords2[1])
+    
+    def consecutive_distances(self, lats, lons, pad = False):
+        """
+        Distance between fix i-1 and fix i
+        """
+        return self.compute_distances(lats[:-1], lons[:-1], lats[1:], lons[1:], pad)
+    
+    def lagged_distances(self, lats, lons, lag_index):
+        """
+        Distance between fix lag_index[i] and fix i
+        """
+        return self.compute_distances(lats[lag_index], lons[lag_index], lats, lons)
+    
+    def distances_to_point(self, lats, lons, lat0, lon0):
+        """
+        Distance between each fix and the point (lat0, lon0)
+        """
+        lats = np.asarray(lats)
+        return self.compute_distances(lats, lons, np.full(lats.shape, lat0), np.full(lats.shape, lon0))
+    
+    def _finalize(self, d, pad):
+        d = np.asarray(d, dtype=np.float64)
+        d[np.isnan(d)] = 0.
+        if pad:
+            d = np.concatenate( (np.zeros(1), d) )
+        return d
+
 
 if has_pyproj:  
-    class GeodesicDistancePyproj:
+    class GeodesicDistancePyproj(GeodesicDistanceBase):
+        """
+        Karney geodesics computed by pyproj on whole arrays at once.
+        """
         def __init__(self, ellps = 'WGS84'):
             self.g = Geod(ellps=ellps)
         
         def compute_distances(self, latitudes1, longitudes1, latitudes2, longitudes2, pad = False):
-            d = [self.compute_distance(lat1,lon1,lat2, lon2)
-                             for (lat1,lon1,lat2, lon2) in zip(latitudes1, longitudes1,
-                                                                latitudes2, longitudes2) ]
-            if pad:
-                d.insert(0, 0.)
-        
-            return np.array(d)        
+            latitudes1 = np.asarray(latitudes1, dtype=np.float64)
+            if latitudes1.shape[0] == 0:
+                return self._finalize(latitudes1, pad)
+            
+            d = self.g.inv(np.asarray(longitudes1, dtype=np.float64), latitudes1,
+                           np.asarray(longitudes2, dtype=np.float64), np.asarray(latitudes2, dtype=np.float64))[2]
+            return self._finalize(d, pad)
     
-        
         def compute_distance(self, lat1, lon1, lat2, lon2):
-            d = self.g.inv(lat1, lon1, lat2, lon2)[2]
+            d = self.g.inv(lon1, lat1, lon2, lat2)[2]
             if(np.isnan(d)):
                 d = 0.
                 
             return d
     
-class GeodesicDistanceGeopy:
+class GeodesicDistanceGeopy(GeodesicDistanceBase):
     def __init__(self, ellps = 'WGS84'):
         #self.g = Geod(ellps=ellps)
         pass
@@ -74,10 +117,7 @@ class GeodesicDistanceGeopy:
         d = [self.compute_distance(lat1,lon1,lat2, lon2)
                          for (lat1,lon1,lat2, lon2) in zip(latitudes1, longitudes1,
                                                             latitudes2, longitudes2) ]
-        if pad:
-            d.insert(0, 0.)
-    
-        return np.array(d)        
+        return self._finalize(d, pad)
 
     
     def compute_distance(self, lat1, lon1, lat2, lon2):
@@ -97,5 +137,134 @@ class GeodesicDistanceGeopy:
             d = 0.
             
         return d
+
+class HaversineDistance(GeodesicDistanceBase):
+    """
+    Great circle distance on a sphere of radius R (meters).
+    Relative error w.r.t. the WGS84 geodesic is at most about 0.5%.
+    """
+    def __init__(self, R = 6371008.8):
+        self.R = R
+        
+    def compute_distances(self, latitudes1, longitudes1, latitudes2, longitudes2, pad = False):
+        lat1 = np.radians(latitudes1)
+        lat2 = np.radians(latitudes2)
+        dlat = lat2 - lat1
+        dlon = np.radians( np.asarray(longitudes2, dtype=np.float64) - longitudes1 )
+        a = np.sin(.5*dlat)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(.5*dlon)**2
+        d = 2.*self.R*np.arcsin( np.sqrt( np.minimum(a, 1.) ) )
+        return self._finalize(d, pad)
+    
+class TangentPlaneDistance(GeodesicDistanceBase):
+    """
+    Euclidean distance in the plane tangent to the WGS84 ellipsoid at the mid-point
+    of each pair (equirectangular approximation with the meridional and prime vertical
+    radii of curvature). Accurate to millimeters for fixes a few hundred meters apart.
+    """
+    def __init__(self, a = 6378137.0, f = 1./298.257223563):
+        self.a  = a
+        self.e2 = f*(2. - f)
+        
+    def compute_distances(self, latitudes1, longitudes1, latitudes2, longitudes2, pad = False):
+        lat1 = np.radians(latitudes1)
+        lat2 = np.radians(latitudes2)
+        lat_m = .5*(lat1 + lat2)
+        w2 = 1. - self.e2*np.sin(lat_m)**2
+        N = self.a/np.sqrt(w2)
+        M = N*(1. - self.e2)/w2
+        dx = N*np.cos(lat_m)*np.radians( np.asarray(longitudes2, dtype=np.float64) - longitudes1 )
+        dy = M*(lat2 - lat1)
+        return self._finalize(np.hypot(dx, dy), pad)
+    
+class FixDistances:
+    """
+    Distances between the fixes of a participant given by index, and between fixes
+    and arbitrary points.
+    
+    If a projection (e.g. UTMprojection) is given, the fixes are projected once to
+    local metric coordinates (x, y) and all the distances are Euclidean distances
+    in that frame. Otherwise the distance backend g is used on latitudes and longitudes.
+    """
+    def __init__(self, latitudes, longitudes, g, proj=None, xy=None):
+        self.latitudes  = latitudes
+        self.longitudes = longitudes
+        self.g    = g
+        self.proj = proj
+        self.x    = None
+        self.y    = None
+        if proj is not None:
+            if xy is None:
+                xy = proj.get_xys(latitudes, longitudes)
+            self.x, self.y = xy
+            
+    def between(self, i, j):
+        """
+        Distance between fix i and fix j (scalars or arrays of indexes)
+        """
+        if self.proj is not None:
+            return np.hypot(self.x[i] - self.x[j], self.y[i] - self.y[j])
+        elif np.ndim(i) == 0 and np.ndim(j) == 0:
+            return self.g.compute_distance(self.latitudes[i], self.longitudes[i],
+                                           self.latitudes[j], self.longitudes[j])
+        else:
+            i, j = np.broadcast_arrays(i, j)
+            return self.g.compute_distances(self.latitudes[i], self.longitudes[i],
+                                            self.latitudes[j], self.longitudes[j])
     
-GeodesicDistance = GeodesicDistanceGeopy
+    def consecutive(self, pad = False):
+        """
+        Distance between fix i-1 and fix i
+        """
+        if self.proj is not None:
+            d = np.hypot(np.diff(self.x), np.diff(self.y))
+            if pad:
+                d = np.concatenate( (np.zeros(1), d) )
+            return d
+        else:
+            return self.g.consecutive_distances(self.latitudes, self.longitudes, pad)
+        
+    def to_point(self, index, lat0, lon0):
+        """
+        Distance between the fixes index (array of indexes or slice) and the point (lat0, lon0),
+        or the points lat0[k], lon0[k] (arrays with one entry per fix)
+        """
+        if self.proj is not None:
+            x0, y0 = self.proj.get_xy(lat0, lon0)
+            return np.hypot(self.x[index] - x0, self.y[index] - y0)
+        else:
+            return self.g.distances_to_point(self.latitudes[index], self.longitudes[index], lat0, lon0)
+        
+    def points(self, lat1, lon1, lat2, lon2):
+        """
+        Distance between two points that are not fixes (e.g. centroids), or between
+        arrays of points
+        """
+        if self.proj is not None:
+            x1, y1 = self.proj.get_xy(lat1, lon1)
+            x2, y2 = self.proj.get_xy(lat2, lon2)
+            return np.hypot(x1 - x2, y1 - y2)
+        elif np.ndim(lat1) == 0 and np.ndim(lat2) == 0:
+            return self.g.compute_distance(lat1, lon1, lat2, lon2)
+        else:
+            lat1, lon1, lat2, lon2 = np.broadcast_arrays(lat1, lon1, lat2, lon2)
+            return self.g.compute_distances(lat1, lon1, lat2, lon2)
+    
+distanceBackends = {"geopy": GeodesicDistanceGeopy,
+                    "haversine": HaversineDistance,
+                    "tangent_plane": TangentPlaneDistance}
+if has_pyproj:
+    distanceBackends["pyproj"] = GeodesicDistancePyproj
+    
+def GeodesicDistance(backend = None):
+    """
+    Return an instance of the distance backend (see distanceBackends).
+    By default the pyproj geodesic is used if available, geopy otherwise.
+    """
+    if backend is None:
+        backend = "pyproj" if has_pyproj else "geopy"
+        
+    if backend not in distanceBackends:
+        raise ValueError("Unknown distance backend {0}. Available backends: {1}".format(
+                         backend, ", ".join(sorted(distanceBackends.keys())) ) )
+        
+    return distanceBackends[backend]()
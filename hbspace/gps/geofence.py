@@ -0,0 +1,127 @@
+# 
+# This file is part of the Health Behavior in Space software (https://github.com/dsalvolab/hbspace).
+# Copyright (c) 2022 Umberto Villa.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import numpy as np
+
+from .gridIndex import GridCells, degrees_within, expand_ranges
+
+class GeofenceLayer:
+    """
+    A named layer of places (e.g. parks, schools): place_id -> shape, where the shape
+    is a circle (latitude, longitude, radius in meters) or a polygon (list of
+    (latitude, longitude) vertices). Places are indexed by the cells (in degrees)
+    covered by their bounding box; build the layer once and use it for all the participants.
+    """
+    def __init__(self, name, places, cell=1e-3):
+        self.name = name
+        self.grid = GridCells(cell)
+        n = len(places)
+        self.ids       = np.array(list(places.keys()), dtype=np.int64)
+        self.is_circle = np.zeros(n, dtype=bool)
+        self.clat      = np.zeros(n)
+        self.clon      = np.zeros(n)
+        self.cradius   = np.zeros(n)
+        self.bbox      = np.zeros((n, 4))   # lat_min, lat_max, lon_min, lon_max
+        vertices = []
+        self.vlengths  = np.zeros(n, dtype=np.int64)
+        
+        for k, shape in enumerate(places.values()):
+            if len(shape) == 3 and np.ndim(shape[0]) == 0:
+                lat, lon, radius = shape
+                dlat = degrees_within(radius)
+                dlon = degrees_within(radius, abs(lat) + dlat)
+                self.is_circle[k] = True
+                self.clat[k], self.clon[k], self.cradius[k] = lat, lon, radius
+                self.bbox[k] = (lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+            else:
+                v = np.asarray(shape, dtype=np.float64).reshape(-1, 2)
+                assert v.shape[0] >= 3, "Polygon {0} of layer {1} has less than 3 vertices".format(self.ids[k], name)
+                vertices.append(v)
+                self.vlengths[k] = v.shape[0]
+                self.bbox[k] = (v[:,0].min(), v[:,0].max(), v[:,1].min(), v[:,1].max())
+        
+        vertices = np.concatenate(vertices) if vertices else np.zeros((0, 2))
+        self.vlat = vertices[:,0]
+        self.vlon = vertices[:,1]
+        self.voffsets = np.cumsum(self.vlengths) - self.vlengths
+        
+        keys  = []
+        place = []
+        i0, j0 = self.grid.cells(self.bbox[:,0], self.bbox[:,2])
+        i1, j1 = self.grid.cells(self.bbox[:,1], self.bbox[:,3])
+        for k in range(n):
+            i, j = np.meshgrid(np.arange(i0[k], i1[k]+1), np.arange(j0[k], j1[k]+1))
+            keys.append( self.grid.key(i, j).ravel() )
+            place.append( np.full(keys[-1].shape[0], k) )
+        keys  = np.concatenate(keys) if n else np.zeros(0, dtype=np.int64)
+        place = np.concatenate(place) if n else np.zeros(0, dtype=np.int64)
+        order = np.argsort(keys, kind="stable")
+        self.keys  = keys[order]
+        self.place = place[order]
+        
+    def locate(self, fd):
+        """
+        Place id of each fix of fd (FixDistances), -1 if the fix is not in any place.
+        If places overlap, the first one in the layer wins.
+        """
+        lats, lons = fd.latitudes, fd.longitudes
+        n = lats.shape[0]
+        out = -np.ones(n, dtype=np.int64)
+        if n == 0 or self.keys.shape[0] == 0:
+            return out
+        
+        # Candidate (fix, place) pairs: places registered in the cell of the fix
+        keys = self.grid.keys(lats, lons)
+        point, candidate, _, _ = expand_ranges(np.searchsorted(self.keys, keys, side="left"),
+                                               np.searchsorted(self.keys, keys, side="right"))
+        place = self.place[candidate]
+        
+        bbox = self.bbox[place]
+        keep = (lats[point] >= bbox[:,0]) & (lats[point] <= bbox[:,1]) & \
+               (lons[point] >= bbox[:,2]) & (lons[point] <= bbox[:,3])
+        point, place = point[keep], place[keep]
+        
+        inside = np.zeros(point.shape[0], dtype=bool)
+        
+        circle = self.is_circle[place]
+        if np.any(circle):
+            pc = place[circle]
+            inside[circle] = fd.to_point(point[circle], self.clat[pc], self.clon[pc]) <= self.cradius[pc]
+            
+        polygon = np.where(~circle)[0]
+        if polygon.shape[0]:
+            # Ray casting: count the edges crossed by a ray from the fix towards increasing longitude
+            pp = place[polygon]
+            vstart, vstop = self.voffsets[pp], self.voffsets[pp] + self.vlengths[pp]
+            pair, v0, _, _ = expand_ranges(vstart, vstop)
+            v1 = np.where(v0 + 1 == vstop[pair], vstart[pair], v0 + 1)
+            y, x = lats[point[polygon]][pair], lons[point[polygon]][pair]
+            ya, yb = self.vlat[v0], self.vlat[v1]
+            xa, xb = self.vlon[v0], self.vlon[v1]
+            straddle = (ya > y) != (yb > y)
+            dy = np.where(straddle, yb - ya, 1.)
+            cross = straddle & (x < xa + (y - ya)*(xb - xa)/dy)
+            crossings = np.bincount(pair, weights=cross, minlength=polygon.shape[0])
+            inside[polygon] = crossings % 2 == 1
+        
+        point, place = point[inside], place[inside]
+        order = np.lexsort((place, point))
+        point, place = point[order], place[order]
+        first = np.concatenate(([True], point[1:] != point[:-1])) if point.shape[0] else np.zeros(0, dtype=bool)
+        out[point[first]] = self.ids[place[first]]
+        return out
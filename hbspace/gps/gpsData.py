@@ -16,9 +16,13 @@
 #
 
 import numpy as np
-from .trip import Trip
-from .location import Visit, Location
-from .distance import GeodesicDistance
+from concurrent.futures import ProcessPoolExecutor
+from .trip import Trip, TripTable, trip_mode_code
+from .location import Visit, Location, VisitTable, LocationTable, LocationGrid
+from .storeIndex import StoreIndex
+from .gridIndex import expand_ranges
+from .distance import GeodesicDistance, FixDistances
+from . import projection
 from ..common.conversions import meter_per_second_to_km_per_hour,\
     km_per_hour_to_meter_per_second
     
@@ -44,16 +48,18 @@ class GPSData:
     PAUSE      = 2
     MOTION_NOT_TRIP = -1
     
-    def __init__(self, id, fname, proj=None):
+    def __init__(self, id, fname, proj=None, distance=None):
         
-        self.g = GeodesicDistance()
+        if distance is None:
+            distance = GeodesicDistance()
+        self.g = distance
         self.proj = proj
+        self.xy   = None
         
         self.id = id
         self.fname = fname
         
         self.timestamps     = None
-        self.local_datetime = None
         self.latitudes      = None
         self.longitudes     = None
         self.elevations     = None
@@ -61,6 +67,7 @@ class GPSData:
         self.is_last_fix    = None
         
         self.valid_fixes_id = None
+        self.source_index   = None
         self.ntotal_fixes   = None
         
         self.speeds      = None
@@ -74,60 +81,112 @@ class GPSData:
         
         self.is_valid        = None
         
-        self.trips = []
-        self.locations = []
-        self.visits = []
+        self.trips     = TripTable()
+        self.visits    = VisitTable()
+        self.locations = LocationTable(self.visits)
         
         self.locationCounter = 0
         self.tripCounter     = 0
         self.visitCounter    = 0
         
         self.home_coords  = None
+        self.homes        = None
+        self.home_index   = None
         self.is_home      = None
         
         self.store_maps_coords = None
         self.store_id     = None
         self.store_marker = None
         
+        self.geofences = {}   # Layer name -> place id of each fix (-1: none)
+        
         self.unordered_source = False
         self.logging = False
         
+        self._derived = {}
         
-    def compute_dist(self):        
-        self.speeds      = np.zeros_like(self.timestamps)
-        self.cumdist     = np.zeros_like(self.timestamps)
-        
-        prev_time    = None
-        prev_coords  = None
-        rundist     =  0
         
-        for i in np.arange(self.timestamps.shape[0]):
-            if self.is_first_fix[i]:
-                prev_coords  = (self.latitudes[i], self.longitudes[i])
-                prev_time    = self.timestamps[i]
-                rundist      = 0
-                self.cumdist[i]  = 0
-                
-                next_coords = (self.latitudes[i+1], self.longitudes[i+1])
-                next_time  = self.timestamps[i+1]
-                
-                d =  self.g.compute_distance_t(prev_coords, next_coords)
-                
-                self.speeds[i]   = d/(next_time - prev_time)
-            else:
-                cur_coords = (self.latitudes[i], self.longitudes[i])
-                cur_time   = self.timestamps[i]
-                
-                cur_dist   = self.g.compute_distance_t(prev_coords, cur_coords)
-                
-                assert np.isnan(cur_dist)==False 
-                
-                rundist += cur_dist
-                self.cumdist[i] = rundist
-                self.speeds[i]  = meter_per_second_to_km_per_hour( cur_dist / (cur_time - prev_time) )
-                
-                prev_coords = cur_coords
-                prev_time   = cur_time
+    def _derived_array(self, name, builder):
+        """
+        Arrays derived from the fixes (distances, time deltas, lag indices) are
+        computed once, on first use, and shared by all the stages of the pipeline.
+        """
+        if name not in self._derived:
+            self._derived[name] = builder()
+        return self._derived[name]
+    
+    def fix_distances(self):
+        """
+        Distances between fixes, Euclidean in the projected coordinates if proj is set (see FixDistances)
+        """
+        return self._derived_array("fix_distances",
+                                   lambda: FixDistances(self.latitudes, self.longitudes, self.g, self.proj, self.xy))
+    
+    def get_xys(self):
+        """
+        Projected coordinates (meters) of the fixes
+        """
+        fd = self.fix_distances()
+        if fd.proj is not None:
+            return fd.x, fd.y
+        proj = projection.utm_projection(self.latitudes, self.longitudes)
+        return proj.get_xys(self.latitudes, self.longitudes)
+    
+    def step_distances(self):
+        """
+        Distance (meters) between fix i-1 and fix i (0 for the first fix)
+        """
+        return self._derived_array("step_distances",
+                                   lambda: self.fix_distances().consecutive(pad=True))
+    
+    def time_deltas(self):
+        """
+        Time (seconds) between fix i-1 and fix i (0 for the first fix)
+        """
+        def builder():
+            dt = np.zeros(self.timestamps.shape[0], dtype=self.timestamps.dtype)
+            dt[1:] = np.diff(self.timestamps)
+            return dt
+        return self._derived_array("time_deltas", builder)
+    
+    def lag_index(self, window=60):
+        """
+        Index of the last fix more than window seconds before fix i, or of the first fix
+        of the segment if there is none
+        """
+        def builder():
+            n = self.timestamps.shape[0]
+            segment_start = np.maximum.accumulate( np.where(self.is_first_fix == 1, np.arange(n), 0) )
+            lag = np.searchsorted(self.timestamps, self.timestamps - window, side='left') - 1
+            return np.maximum(lag, segment_start)
+        return self._derived_array("lag_index_{0}".format(window), builder)
+    
+    def lagged_distances(self, window=60):
+        """
+        Distance (meters) between fix lag_index[i] and fix i
+        """
+        return self._derived_array("lagged_distances_{0}".format(window),
+                                   lambda: self.fix_distances().between(self.lag_index(window), np.arange(self.timestamps.shape[0])))
+        
+    def compute_dist(self):
+        """
+        Speed (km/h) and cumulative distance within each segment.
+        The speed of the first fix of a segment is the (m/s) speed towards the next fix.
+        """
+        step_dist = self.step_distances()
+        dt = self.time_deltas()
+        first = self.is_first_fix == 1
+        
+        self.speeds = np.zeros(self.timestamps.shape[0])
+        not_first = np.where(~first)[0]
+        self.speeds[not_first] = meter_per_second_to_km_per_hour( step_dist[not_first]/dt[not_first] )
+        first_fixes = np.where(first[:-1])[0]
+        self.speeds[first_fixes] = step_dist[first_fixes+1]/dt[first_fixes+1]
+        
+        segment_dist = np.where(first, 0., step_dist)
+        cumdist = np.cumsum(segment_dist)
+        segment_start = np.maximum.accumulate( np.where(first, np.arange(first.shape[0]), 0) )
+        self.cumdist = cumdist - cumdist[segment_start]
                 
     def measurement_time(self):
         self._fix_first_last_fixes()
@@ -143,93 +202,210 @@ class GPSData:
         return tot_time_hours, tot_valid_time_hours, tot_time_hours-tot_valid_time_hours
     
     def mark_home(self, home_coords, radius):
+        """
+        Mark the fixes within radius of the home. home_coords is the (latitude, longitude)
+        of the home, or a list of home periods (latitude, longitude, start, end) as returned
+        by homeAddresses: each fix is compared to the home of the period of its timestamp.
+        """
         self.home_coords = home_coords
-        self.is_home = np.zeros_like(self.timestamps)
-        for i in np.arange(self.timestamps.shape[0]):
-            fix = self._getFix(i)
-            d = self.g.compute_distance_t(fix.coords, home_coords)
-            if d < radius:
-                self.is_home[i] = 1
+        self.homes, self.home_index = self._join_home_periods(home_coords)
+        self.is_home = np.zeros(self.timestamps.shape[0], dtype=np.uint8)
+        fd = self.fix_distances()
+        for k in range(self.homes.shape[0]):
+            fixes = np.where(self.home_index == k)[0]
+            self.is_home[fixes] = fd.to_point(fixes, self.homes[k,0], self.homes[k,1]) < radius
+            
+    def _join_home_periods(self, home_coords):
+        """
+        Array of home coordinates and, for each fix, the home whose period contains its
+        timestamp (start included, end excluded, None for open ends), -1 if none.
+        Start and end are numpy.datetime64 or ISO strings (see homeAddresses for other formats).
+        Periods are assumed not to overlap.
+        """
+        n = self.timestamps.shape[0]
+        if np.ndim(home_coords[0]) == 0:
+            return np.array([home_coords[:2]], dtype=np.float64), np.zeros(n, dtype=np.int32)
+        
+        homes = np.array([(p[0], p[1]) for p in home_coords], dtype=np.float64).reshape(-1, 2)
+        never = np.iinfo(np.int64)
+        def seconds(bound, default):
+            if bound is None:
+                return default
+            try:
+                return np.datetime64(bound, 's').astype(np.int64)
+            except ValueError:
+                raise ValueError("Home period bound {0!r} is not an ISO date (YYYY-MM-DD[ HH:MM:SS])".format(bound))
+        starts = np.array([seconds(p[2], never.min) for p in home_coords], dtype=np.int64)
+        ends   = np.array([seconds(p[3], never.max) for p in home_coords], dtype=np.int64)
+        
+        order = np.argsort(starts, kind="stable")
+        k = np.searchsorted(starts[order], self.timestamps, side="right") - 1
+        home_index = np.where(k >= 0, order[np.maximum(k, 0)], -1).astype(np.int32)
+        home_index[(home_index >= 0) & (self.timestamps >= ends[home_index])] = -1
+        return homes, home_index
+    
+    def home_at(self, index):
+        """
+        Latitudes and longitudes of the home of the fixes index (NaN if no home applies)
+        """
+        home_index = self.home_index[index]
+        lats = np.where(home_index >= 0, self.homes[home_index, 0], np.nan)
+        lons = np.where(home_index >= 0, self.homes[home_index, 1], np.nan)
+        return lats, lons
                 
-    def mark_store(self, store_maps_coords, radius):
+    def mark_store(self, store_maps_coords, radius, index=None):
+        """
+        Mark the fixes whose nearest store (in the latitude/longitude plane) is within radius.
+        index is a StoreIndex of store_maps_coords (built here if not given).
+        """
         self.store_maps_coords = store_maps_coords
-        self.store_id     = -np.ones_like(self.timestamps)
-        self.store_marker = -np.ones_like(self.timestamps)
-        for i in np.arange(self.timestamps.shape[0]):
-            fix = self._getFix(i)
-            d = np.inf
-            my_ci = None
-            for store_id, data in store_maps_coords.items():
-                ci = (data[0], data[1])
-                marker = data[2]
-                di = (fix.coords[0]-ci[0])**2+(fix.coords[1]-ci[1])**2#self.g.compute_distance_t(fix.coords, ci)
-                if di < d:
-                    d = di
-                    self.store_id[i] = store_id
-                    self.store_marker[i] = marker
-                    my_ci = ci
-                    
-            d = self.g.compute_distance_t(fix.coords, my_ci)
-            if d > radius:
-                self.store_id[i]     = -1
-                self.store_marker[i] = -1
+        if index is None:
+            index = StoreIndex(store_maps_coords)
+        self.store_id     = -np.ones(self.timestamps.shape[0], dtype=np.int32)
+        self.store_marker = -np.ones(self.timestamps.shape[0], dtype=np.int8)
+        
+        nearest = index.nearest(self.latitudes, self.longitudes, radius)
+        fixes = np.where(nearest >= 0)[0]
+        stores = nearest[fixes]
+        d = self.fix_distances().to_point(fixes, index.lats[stores], index.lons[stores])
+        fixes, stores = fixes[d <= radius], stores[d <= radius]
+        self.store_id[fixes]     = index.ids[stores]
+        self.store_marker[fixes] = index.markers[stores]
+        
+    def mark_geofences(self, layers):
+        """
+        Place of each fix in each GeofenceLayer of layers
+        """
+        for layer in layers:
+            self.geofences[layer.name] = layer.locate(self.fix_distances())
             
-
-            
-        
-    def trip_detection(self, trip_parameters):
-                
+    def _segment_majority(self, values, visit, n, lengths):
+        """
+        Most frequent value (the smallest in case of ties) of each of the n segments
+        (values[visit == k] for segment k) and the fraction of entries with that value
+        """
+        unique, codes = np.unique(values, return_inverse=True)
+        counts = np.bincount(visit*unique.shape[0] + codes.ravel(), minlength=n*unique.shape[0])
+        counts = counts.reshape(n, unique.shape[0])
+        best = np.argmax(counts, axis=1)
+        return unique[best], counts[np.arange(n), best]/lengths
+        
+    def _segments(self):
+        """
+        List of (start, stop) of the segments of fixes between two losses of signal
+        """
         first_fixes = np.where(self.is_first_fix == 1)[0]
         last_fixes  = np.where(self.is_last_fix == 1)[0]
         if first_fixes.shape[0] != last_fixes.shape[0]:
             print("Error:", first_fixes.shape[0], last_fixes.shape[0])
             raise
         
-        self.state       = -np.ones_like(self.timestamps, dtype=np.int)
-        self.trip_marker = -np.ones_like(self.timestamps, dtype=np.int)
+        return [(int(f), int(l)+1) for (f, l) in zip(first_fixes, last_fixes)]
+    
+    def _segment(self, start, stop):
+        """
+        GPSData restricted to the fixes start:stop of a segment, used to process
+        segments independently (and possibly in other processes).
+        Indexes of trips and visits of the segment are relative to start.
+        """
+        out = GPSData(self.id, self.fname, self.proj, self.g)
+        for name in ["timestamps", "latitudes", "longitudes", "elevations", "is_first_fix", "is_last_fix",
+                     "speeds", "cumdist", "state", "trip_marker", "is_valid", "is_home", "home_index",
+                     "store_id", "store_marker"]:
+            values = getattr(self, name)
+            if values is not None:
+                setattr(out, name, values[start:stop])
+        if self.xy is not None:
+            out.xy = (self.xy[0][start:stop], self.xy[1][start:stop])
+        for name, values in self._derived.items():
+            if name.startswith("lag_index"):
+                out._derived[name] = values[start:stop] - start
+            elif name != "fix_distances":
+                out._derived[name] = values[start:stop]
+        out.home_coords = self.home_coords
+        out.homes       = self.homes
+        out.geofences = {name: place[start:stop] for name, place in self.geofences.items()}
+        out.logging = self.logging
+        return out
+    
+    def _map_segments(self, worker, parameters, executor):
+        """
+        Apply worker to all the segments, serially or with executor (concurrent.futures.Executor).
+        Results are returned in the order of the segments.
+        """
+        segments = self._segments()
+        args = [(self._segment(start, stop), parameters) for (start, stop) in segments]
+        if executor is None:
+            results = map(worker, args)
+        else:
+            results = executor.map(worker, args)
+        return zip(segments, results)
+        
+    def trip_detection(self, trip_parameters, executor=None):
+        """
+        Detect trips. Segments between losses of signal are independent; if executor
+        (e.g. concurrent.futures.ProcessPoolExecutor) is given they are processed in parallel,
+        and trips are numbered in the order of the segments.
+        """
+        self.state       = -np.ones(self.timestamps.shape[0], dtype=np.int8)
+        self.trip_marker = -np.ones(self.timestamps.shape[0], dtype=np.int32)
         
         assert len(self.trips) == 0
-                
-        for i in np.arange(first_fixes.shape[0]):
-            self._define_state(first_fixes[i], last_fixes[i]+1, trip_parameters)
+        
+        # Lookback distances of all the segments in one batch
+        self.lagged_distances(trip_parameters["lookback"])
+        
+        starts = []
+        ends   = []
+        for (start, stop), (state, seg_starts, seg_ends) in self._map_segments(_segment_trips, trip_parameters, executor):
+            self.state[start:stop] = state
+            starts.append(seg_starts + start)
+            ends.append(seg_ends + start)
             
         if np.any(self.state==-1):
-            print(first_fixes)
             print(np.where(self.state==-1))
             raise
-            
-        for i in np.arange(first_fixes.shape[0]):
-            self._trip_detection(first_fixes[i], last_fixes[i]+1, trip_parameters)
+        
+        self._validateTrips(np.concatenate(starts), np.concatenate(ends), trip_parameters)
             
         print( "Detected {0} trips".format(len(self.trips)) )
         
-        for trip in self.trips:
-            self.trip_marker[trip.start_index:trip.end_index+1] = trip.id
-
-                
+        self._fill_ranges(self.trip_marker, self.trips.column("start_index"), self.trips.column("end_index")+1,
+                          self.trips.column("id"))
             
-    def classify_trip(self, parameters_speed_cutoff):
-        type_count = {}
+    def classify_trip(self, parameters_speed_cutoff, features=("speedAvg", "speedRMax")):
+        """
+        Classify all the trips by comparing the two trip columns in features with the
+        (mean, max) speed cutoffs of each mode, e.g. ("speedP50", "speedP95") for a
+        classification robust to outliers.
+        Speed percentiles and the fraction of time above the mean cutoff of each mode
+        are stored in the trip table.
+        """
+        starts = self.trips.column("start_index")
+        ends   = self.trips.column("end_index")
+        cutoffs = {mode: parameters_speed_cutoff[mode][0] for mode in ["walk", "bike", "vehicle"]}
+        pct, above = self._trip_speed_features(starts, ends, list(cutoffs.values()))
+        for q in [50, 85, 95]:
+            self.trips.column("speedP{0}".format(q))[:] = pct[q]
+        for mode, c in cutoffs.items():
+            self.trips.column("fracAbove" + mode.capitalize())[:] = above[c]
+        
+        self.trips.classify(parameters_speed_cutoff, features)
+        
+        type_code = self.trips.column("type_code")
         for k in parameters_speed_cutoff.keys():
-            type_count[k] = 0
-            
-        for trip in self.trips:
-            trip.classify(parameters_speed_cutoff)
-            type_count[trip.type] += 1
-            
-        for k in type_count:
-            print(type_count[k], " trips of type ", k)
-        
-        self.trip_type =  -np.ones_like(self.timestamps, dtype=np.int)
-        for trip in self.trips:
-            if trip.type=='slow_walk':
-                self.trip_type[trip.start_index:trip.end_index+1] = 0
-            if trip.type=='walk':
-                self.trip_type[trip.start_index:trip.end_index+1] = 1
-            elif trip.type=='bike':
-                self.trip_type[trip.start_index:trip.end_index+1] = 2
-            elif trip.type=='vehicle':
-                self.trip_type[trip.start_index:trip.end_index+1] = 3
+            print(np.sum(type_code == trip_mode_code[k]), " trips of type ", k)
+        
+        self.trip_type =  -np.ones(self.timestamps.shape[0], dtype=np.int8)
+        self._fill_ranges(self.trip_type, self.trips.column("start_index"), self.trips.column("end_index")+1, type_code)
+        
+    def _fill_ranges(self, marker, starts, stops, values):
+        """
+        marker[starts[k]:stops[k]] = values[k] for all k (ranges do not overlap);
+        values can also be a scalar
+        """
+        segment, index, _, _ = expand_ranges(starts, stops)
+        marker[index] = np.broadcast_to(values, starts.shape)[segment]
             
             
     def _trap_points(self, loc_param):
@@ -252,21 +428,21 @@ class GPSData:
             
     
     def location_detection(self, loc_param):
+        """
+        Detect visits (all the segments at once) and merge them into locations.
+        """
         assert self.trip_marker is not None
         
         self._trap_points(loc_param)
         
-        first_fixes = self.is_first_fix.nonzero()[0]
-        last_fixes  = self.is_last_fix.nonzero()[0]
-        
-        self.location_marker = -np.ones_like(self.timestamps, dtype=np.int)
-        self.visit_marker = -np.ones_like(self.timestamps, dtype=np.int)
+        self.location_marker = -np.ones(self.timestamps.shape[0], dtype=np.int32)
+        self.visit_marker = -np.ones(self.timestamps.shape[0], dtype=np.int32)
         assert len(self.locations) == 0
         
         assert len(self.visits) == 0
-                
-        for i in np.arange(first_fixes.shape[0]):
-            self._detect_visits(first_fixes[i], last_fixes[i]+1, loc_param, self.visits)
+        
+        starts, stops = self._visit_candidates(loc_param)
+        self._build_visits(starts, stops, loc_param)
         
         print( "Detected {0} visits".format(len(self.visits)) )
         
@@ -274,295 +450,346 @@ class GPSData:
            
         print( "Detected {0} locations".format(len(self.locations)) )
         
-        for location in self.locations:
-            for (f,l,visitid) in zip(location.first_indexes, location.stops, location.visit_ids):
-                self.location_marker[f:l] = location.id
-                self.visit_marker[f:l]    = visitid
+        starts = self.visits.column("first_index")
+        stops  = self.visits.column("stop")
+        self._fill_ranges(self.location_marker, starts, stops, self.visits.column("locationId"))
+        self._fill_ranges(self.visit_marker, starts, stops, self.visits.column("id"))
             
     def _getFix(self, i):
         if i < self.timestamps.shape[0]:
             return Fix(self.timestamps[i], (self.latitudes[i], self.longitudes[i]), self.elevations[i], i)
         else:
             return None
-            
-    def _get1MinBeforeFix(self,i, start):
-        curr_time = self.timestamps[i]
-        for j in np.arange(i-1, start, -1):
-            j_time = self.timestamps[j]
-            if curr_time - j_time > 60:
-                return self._getFix(j)
-            
-        return self._getFix(start)
-            
-    def _define_state(self, start, stop, trip_parameters):
-      
-        min_dist = trip_parameters["min_dist"]
         
-        possible_pause = False
-        possible_pause_start_index = start
+    @property
+    def local_datetime(self):
+        return self.timestamps.astype('datetime64[s]')
         
-        self.state[start] = self.STATIONARY
-        
-        for i in np.arange(start+1,stop):
-            prev_fix = self._get1MinBeforeFix(i, start)
-            cur_fix = self._getFix(i)
-            dist = self.g.compute_distance_t(prev_fix.coords, cur_fix.coords)
-            
-            if dist > min_dist:
-                self.state[i] = self.MOTION
-                if self.state[i-1] == self.STATIONARY and possible_pause:
-                    stop_len = cur_fix.tstmp - self.timestamps[possible_pause_start_index]
-                    possible_pause = False
-                    if stop_len < trip_parameters["min_pause"]:
-                        self.state[possible_pause_start_index:i] = self.MOTION
-                    elif stop_len < trip_parameters["max_pause"]:
-                        self.state[possible_pause_start_index:i] = self.PAUSE
-                    else:
-                        self.state[possible_pause_start_index:i] = self.STATIONARY
-            else:
-                self.state[i] = self.STATIONARY
-                if self.state[i-1] == self.MOTION:
-                    possible_pause = True
-                    possible_pause_start_index = i
-                    
-        if self.state[start+1] == self.MOTION:
-            self.state[start] = self.MOTION
-                    
-    def _trip_detection(self,start, stop, trip_parameters):
-        
-        self._log("_trip_detection", start, " ", stop)
-        trip_start = None
-        
-        if self.state[start] == self.MOTION:
-            trip_start = start
-            
-        self._log("Trip start: ", trip_start)
-        
-        for i in np.arange(start+1,stop):
-            if self.state[i] == self.MOTION and self.state[i-1] == self.STATIONARY:
-                assert trip_start is None
-                trip_start = i-1
-                self._log("Trip start: ", trip_start)
-            elif self.state[i] == self.STATIONARY and self.state[i-1] == self.MOTION:
-                self._log("Trip end: ", i)
-                trip = self._validateTrip(trip_start, i, trip_parameters)
-                trip_start = None
-                if trip:
-                    self.trips.append( trip )
-
-            elif self.state[i] == self.STATIONARY and self.state[i-1] == self.PAUSE:
-                print("Error going from PAUSE to STATIONARY is forbidden")
-                raise
-            elif self.state[i] == self.PAUSE and self.state[i-1] == self.STATIONARY:
-                print("Error going from STATIONARY to PAUSE is forbidden")
-                raise
-            
-        if trip_start is not None:
-            self._log("Trip end at end of fix: ", i)
-            trip = self._validateTrip(trip_start, stop-1, trip_parameters)
-            if trip:
-                self.trips.append( trip )
-            
-    def _validateTrip(self, start, end, trip_parameters):
-        
-        self._log("_validateTrip", start, " ", end)
-        
-        incomplete_data = self.is_first_fix[start] or self.is_last_fix[end]
-                
-        success =  False
-        for i in np.arange(start,end):
-            my_d = self.get_distance(i+1, start)
-            if my_d > trip_parameters["radius"]:
-                success = True
-                break
+    def local_date(self, i):
+        """
+        Local date of fix i as YYYY-MM-DD
+        """
+        return np.datetime_as_string(np.datetime64(int(self.timestamps[i]), 's'))[:10]
+    
+    def local_time(self, i):
+        """
+        Local time of fix i as HH:MM:SS
+        """
+        return np.datetime_as_string(np.datetime64(int(self.timestamps[i]), 's'))[11:]
             
-        if not success and not incomplete_data:
-            self._log("From start = {0} to end = {1} the diameter only {2} meters".format(start, end, my_d))
-            return None
-        
-        if not success and incomplete_data:
-            self._log("From start = {0} to end = {1} the diameter only {2} meters. Incomplete trip".format(start, end, my_d))
-            self.is_valid[start:end] =  0
-            return None
-        
-        duration = self.timestamps[end] - self.timestamps[start]
-        distance = self.cumdist[end] - self.cumdist[start]
-        trip_is_valid = True
-        
-        if duration < trip_parameters["min_dur"] and not incomplete_data:
-            self._log("From start = {0} to end = {1} is only {2} seconds".format(start, end, duration))
-            trip_is_valid = False
-            return None
-        
-        if duration < trip_parameters["min_dur"] and incomplete_data:
-            self._log("From start = {0} to end = {1} is only {2} seconds.  Incomplete trip".format(start, end, duration))
-            self.is_valid[start:end] =  0
-            return None
-        
-        if distance < trip_parameters["min_length"] and not incomplete_data:
-            self._log("From start = {0} to end = {1} the distance traveled is only {2} meters".format(start, end, distance))
-            trip_is_valid = False
-            return None
-        
-        if distance < trip_parameters["min_length"] and incomplete_data:
-            self._log("From start = {0} to end = {1} the distance traveled is only {2} meters. Incomplete trip".format(start, end, distance))
-            self.is_valid[start:end] =  0
-            return None
+    def _define_state(self, start, stop, trip_parameters):
+        """
+        A fix is in MOTION if it moved more than min_dist over the lookback window.
+        Runs of stationary fixes between two runs of motion are relabelled by their
+        duration: MOTION (< min_pause), PAUSE (< max_pause) or STATIONARY.
+        """
+        lagged_dist = self.lagged_distances(trip_parameters["lookback"])[start:stop]
+        state = np.where(lagged_dist > trip_parameters["min_dist"], self.MOTION, self.STATIONARY).astype(np.int8)
+        state[0] = self.STATIONARY
+        
+        motion = state == self.MOTION
+        # Stationary runs that follow a motion run, and first motion fix after each of them
+        pause_start  = np.where(motion[:-1] & ~motion[1:])[0] + 1
+        motion_start = np.where(~motion[:-1] & motion[1:])[0] + 1
+        pos = np.searchsorted(motion_start, pause_start)
+        pause_start = pause_start[pos < motion_start.shape[0]]
+        pause_stop  = motion_start[pos[pos < motion_start.shape[0]]]
+        
+        if pause_start.shape[0]:
+            stop_len = self.timestamps[start + pause_stop] - self.timestamps[start + pause_start]
+            labels = np.where(stop_len < trip_parameters["min_pause"], self.MOTION,
+                              np.where(stop_len < trip_parameters["max_pause"], self.PAUSE, self.STATIONARY))
+            self._fill_ranges(state, pause_start, pause_stop, labels)
+        
+        if state.shape[0] > 1 and state[1] == self.MOTION:
+            state[0] = self.MOTION
             
-        speedAvg = np.mean(self.speeds[start:end+1])
-        maxSpeedIndex = np.argmax(self.speeds[start:end+1])
-        if maxSpeedIndex == 0:
-            speedMax = self.speeds[start + 1]
-        elif maxSpeedIndex == end-start:
-            speedMax = self.speeds[end - 1]
-        else:
-            speedMax = .5*(self.speeds[start + maxSpeedIndex + 1] + self.speeds[start + maxSpeedIndex - 1])
-        
-        
-        if speedAvg < trip_parameters["min_avg_speed"] and not incomplete_data:
-            self._log("From start = {0} to end = {1} the average speed is only {2} km/hours".format(start, end, speedAvg))
-            trip_is_valid = False
-            return None
-        
-        if speedAvg < trip_parameters["min_avg_speed"] and incomplete_data:
-            self._log("From start = {0} to end = {1} the average speed is only {2} km/hours. Incomplete trip".format(start, end, speedAvg))
-            trip_is_valid = False
-            self.is_valid[start:end] =  0
-            return None
-
-        
-        id = self.tripCounter
-        self.tripCounter += 1
-        trip = Trip(id, start, end,duration, distance, trip_is_valid)
-        
-        trip.crowdist = self.g.compute_distance(self.latitudes[start], self.longitudes[start],
-                                                self.latitudes[end],   self.longitudes[end]    )
+        self.state[start:stop] = state
+                    
+    def _trip_candidates(self, start, stop):
+        """
+        Candidate trips (start and end index arrays) of the segment start:stop:
+        a trip starts at the last stationary fix before a motion run and ends
+        at the first stationary fix after it (or at the end of the segment).
+        """
+        self._log("_trip_candidates", start, " ", stop)
+        state = self.state[start:stop]
+        prev  = state[:-1]
+        curr  = state[1:]
+        
+        if np.any( (curr == self.STATIONARY) & (prev == self.PAUSE) ):
+            print("Error going from PAUSE to STATIONARY is forbidden")
+            raise
+        if np.any( (curr == self.PAUSE) & (prev == self.STATIONARY) ):
+            print("Error going from STATIONARY to PAUSE is forbidden")
+            raise
         
-        trip.radius = trip.crowdist
-        for i in np.arange(start+1, end):
-            d1 = self.g.compute_distance(self.latitudes[start], self.longitudes[start],
-                                                self.latitudes[i], self.longitudes[i] )
-            
-            d2 = self.g.compute_distance(self.latitudes[i], self.longitudes[i],
-                                         self.latitudes[end], self.longitudes[end] )
+        starts = np.where( (curr == self.MOTION) & (prev == self.STATIONARY) )[0] + start
+        ends   = np.where( (curr == self.STATIONARY) & (prev == self.MOTION) )[0] + start + 1
+        if state[0] == self.MOTION:
+            starts = np.concatenate( ([start], starts) )
+        if ends.shape[0] < starts.shape[0]:
+            ends = np.concatenate( (ends, [stop-1]) )
+        assert starts.shape[0] == ends.shape[0]
             
-            trip.radius = max(trip.radius, d1, d2)
-            
-        trip.speedRMax = speedMax
-        
-        trip.speedAvg = speedAvg
-        
-        return trip
+        return starts, ends
+    
+    def _trip_fixes(self, starts, ends):
+        """
+        Fixes of the trips starts[k]:ends[k]+1 concatenated: trip number and fix index of each
+        entry, plus offset and length of each trip in the concatenation (for reduceat)
+        """
+        return expand_ranges(starts, ends + 1)
+    
+    def _trip_speed_features(self, starts, ends, cutoffs, percentiles=(50, 85, 95)):
+        """
+        Speed percentiles (same interpolation as np.percentile) and fraction of time spent
+        above each speed in cutoffs, for all the trips in one segmented pass.
+        Returns two dictionaries: percentile -> array and cutoff -> array.
+        """
+        pct   = {}
+        above = {}
+        if starts.shape[0] == 0:
+            for q in percentiles:
+                pct[q] = np.zeros(0)
+            for c in cutoffs:
+                above[c] = np.zeros(0)
+            return pct, above
+        
+        trip, index, offsets, lengths = self._trip_fixes(starts, ends)
+        speeds = self.speeds[index]
+        
+        sorted_speeds = speeds[np.lexsort((speeds, trip))]
+        for q in percentiles:
+            pos = offsets + (q/100.)*(lengths - 1)
+            lo  = np.floor(pos).astype(np.int64)
+            hi  = np.minimum(lo + 1, offsets + lengths - 1)
+            pct[q] = sorted_speeds[lo] + (sorted_speeds[hi] - sorted_speeds[lo])*(pos - lo)
+        
+        # Time spent moving towards fix i (the first fix of the trip does not count)
+        dt = self.time_deltas()[index].astype(np.float64)
+        dt[offsets] = 0.
+        total = np.add.reduceat(dt, offsets)
+        total[total == 0.] = 1.
+        for c in cutoffs:
+            above[c] = np.add.reduceat(dt*(speeds > c), offsets)/total
+        return pct, above
+        
+    def _trip_geometry(self, starts, ends):
+        """
+        Per-trip quantities of the trips starts[k]:ends[k]+1, computed with segmented
+        reductions over the fixes of all the trips at once.
+        """
+        starts  = np.asarray(starts, dtype=np.int64)
+        ends    = np.asarray(ends, dtype=np.int64)
+        n       = self.timestamps.shape[0]
+        trip, index, offsets, lengths = self._trip_fixes(starts, ends)
+        
+        fd = self.fix_distances()
+        out = {}
+        out["from_origin"]    = np.maximum.reduceat(fd.between(starts[trip], index), offsets)
+        out["to_destination"] = np.maximum.reduceat(fd.between(index, ends[trip]), offsets)
+        out["crowdist"]       = fd.between(starts, ends)
+        out["duration"]       = self.timestamps[ends] - self.timestamps[starts]
+        out["distance"]       = self.cumdist[ends] - self.cumdist[starts]
+        
+        speeds = self.speeds[index]
+        out["speed_avg"] = np.add.reduceat(speeds, offsets)/lengths
+        
+        # Robust max speed: average of the neighbours of the (first) fix with max speed
+        is_max = speeds == np.maximum.reduceat(speeds, offsets)[trip]
+        first_max = np.where(is_max)[0]
+        first_max = first_max[ np.unique(trip[first_max], return_index=True)[1] ]
+        k = first_max - offsets
+        i = starts + k
+        inner = .5*(self.speeds[np.minimum(i+1, n-1)] + self.speeds[np.maximum(i-1, 0)])
+        out["speed_rmax"] = np.where(k == 0, self.speeds[np.minimum(starts+1, n-1)],
+                                     np.where(k == ends-starts, self.speeds[np.maximum(ends-1, 0)], inner))
+        return out
+    
+    def _validateTrips(self, starts, ends, trip_parameters):
+        """
+        Validate all the candidate trips at once and append the valid ones to self.trips.
+        Rejected trips at the boundary of a segment (incomplete data) are marked as invalid fixes.
+        """
+        if starts.shape[0] == 0:
+            return
         
-    def _detect_visits(self, start, stop, location_parameters, visits):
-                      
-        if self.state[start] == self.STATIONARY:
-            location_start = start
-        elif self.state[start] == self.MOTION:
-            location_start = None
-        else:
+        geometry = self._trip_geometry(starts, ends)
+        incomplete_data = (self.is_first_fix[starts] == 1) | (self.is_last_fix[ends] == 1)
+        
+        failed = np.full(starts.shape[0], "", dtype=object)
+        tests = [(geometry["from_origin"] <= trip_parameters["radius"],     "the diameter is only {0} meters", "from_origin"),
+                 (geometry["duration"] < trip_parameters["min_dur"],        "is only {0} seconds", "duration"),
+                 (geometry["distance"] < trip_parameters["min_length"],     "the distance traveled is only {0} meters", "distance"),
+                 (geometry["speed_avg"] < trip_parameters["min_avg_speed"], "the average speed is only {0} km/hours", "speed_avg")]
+        is_valid = np.ones(starts.shape[0], dtype=bool)
+        for (mask, message, key) in tests:
+            if self.logging:
+                for k in np.where(mask & is_valid)[0]:
+                    self._log("From start = {0} to end = {1} ".format(starts[k], ends[k]) + message.format(geometry[key][k]) +
+                              (". Incomplete trip" if incomplete_data[k] else ""))
+            is_valid &= ~mask
+        
+        for k in np.where(~is_valid & incomplete_data)[0]:
+            self.is_valid[starts[k]:ends[k]] = 0
+        
+        ntrips = int(np.sum(is_valid))
+        self.trips.extend(id          = np.arange(self.tripCounter, self.tripCounter + ntrips),
+                          start_index = starts[is_valid],
+                          end_index   = ends[is_valid],
+                          duration    = geometry["duration"][is_valid],
+                          distance    = geometry["distance"][is_valid],
+                          is_valid    = np.ones(ntrips),
+                          crowdist    = geometry["crowdist"][is_valid],
+                          radius      = np.maximum(geometry["from_origin"], geometry["to_destination"])[is_valid],
+                          speedRMax   = geometry["speed_rmax"][is_valid],
+                          speedAvg    = geometry["speed_avg"][is_valid])
+        self.tripCounter += ntrips
+        
+    def _visit_candidates(self, location_parameters):
+        """
+        Candidate visits (start and stop index arrays) of the whole participant:
+        runs of STATIONARY fixes (and PAUSE fixes if location_parameters["pause"])
+        within the segments between losses of signal.
+        """
+        n = self.timestamps.shape[0]
+        segments = np.array(self._segments(), dtype=np.int64).reshape(-1, 2)
+        seg_starts, seg_stops = segments[:,0], segments[:,1]
+        
+        bad = (self.state[seg_starts] != self.STATIONARY) & (self.state[seg_starts] != self.MOTION)
+        if np.any(bad):
+            print("Error segment starting at {0} in state {1}".format(seg_starts[bad][0], self.state[seg_starts[bad][0]]))
             raise
         
         if location_parameters["pause"]:
-            for i in np.arange(start+1,stop):
-                if self.state[i] in [self.STATIONARY, self.PAUSE] and self.state[i-1] in [self.MOTION]:
-                    assert location_start is None
-                    location_start = i
-                elif self.state[i] == self.MOTION and self.state[i-1] in [self.STATIONARY, self.PAUSE]:
-                    visit = self._isVisit(location_start, i, location_parameters)
-                    location_start = None
-                    if visit:
-                        visits.append( visit )               
+            in_visit = (self.state == self.STATIONARY) | (self.state == self.PAUSE)
         else:
-            for i in np.arange(start+1,stop):
-                if self.state[i] in [self.STATIONARY] and self.state[i-1] == self.MOTION:
-                    assert location_start is None
-                    location_start = i
-                elif self.state[i] == self.MOTION and self.state[i-1] in [self.STATIONARY]:
-                    visit = self._isVisit(location_start, i, location_parameters)
-                    location_start = None
-                    if visit:
-                        visits.append( visit )
-        
-        if location_start is not None:
-            visit = self._isVisit(location_start, stop, location_parameters)
-            if visit:
-                visits.append( visit )
+            in_visit = self.state == self.STATIONARY
+        covered = np.zeros(n, dtype=bool)
+        self._fill_ranges(covered, seg_starts, seg_stops, True)
+        in_visit &= covered
+        
+        first = np.zeros(n, dtype=bool)
+        first[seg_starts] = True
+        last = np.zeros(n, dtype=bool)
+        last[seg_stops-1] = True
+        prev = np.concatenate( ([False], in_visit[:-1]) )
+        nxt  = np.concatenate( (in_visit[1:], [False]) )
+        
+        starts = np.where( in_visit & (first | ~prev) )[0]
+        stops  = np.where( in_visit & (last | ~nxt) )[0] + 1
+        assert starts.shape[0] == stops.shape[0]
+        return starts, stops
                     
-    def _isVisit(self, start_index, stop, location_parameters):
-        
-        if(start_index > stop):
-            print("Start index: ", start_index, "Last index: ", stop)
-            raise
-        
-        if self.timestamps[stop-1] < self.timestamps[start_index]:
-            print("Start index time: ", self.local_datetime[start_index], start_index)
-            print("End index time: ", self.local_datetime[stop-1], stop-1)
-        
-        incomplete_data = self.is_first_fix[start_index] or self.is_last_fix[stop-1]
+    def _build_visits(self, starts, stops, location_parameters):
+        """
+        Validate the candidate visits starts[k]:stops[k] and append them to self.visits.
+        Duration, centroid, radius and home flag of all the visits are computed
+        by segmented reductions over the concatenated fixes of the visits.
+        """
+        min_time = location_parameters["min_time"]
+        
+        reversed_time = self.timestamps[stops-1] < self.timestamps[starts]
+        for k in np.where(reversed_time)[0]:
+            print("Start index time: ", self.local_date(starts[k]), self.local_time(starts[k]), starts[k])
+            print("End index time: ", self.local_date(stops[k]-1), self.local_time(stops[k]-1), stops[k]-1)
+        
+        incomplete_data = (self.is_first_fix[starts] == 1) | (self.is_last_fix[stops-1] == 1)
+        duration = (self.timestamps[stops-1] - self.timestamps[starts]).astype(np.float64)
+        
+        visit, index, offsets, lengths = self._trip_fixes(starts, stops-1)
+        
+        if starts.shape[0]:
+            is_pause = np.add.reduceat((self.state[index] <= self.STATIONARY).astype(np.int64), offsets) == 0
+        else:
+            is_pause = np.zeros(0, dtype=bool)
+        for k in np.where(is_pause)[0]:
+            self._log("Detected pause between {0} and {1} of length {2}".format(starts[k], stops[k], duration[k]))
         
-        duration = self.timestamps[stop-1] - self.timestamps[start_index]
-
-        is_pause = np.all(self.state[start_index:stop] > self.STATIONARY)
+        short = duration < min_time
+        for k in np.where(short & ~is_pause & ~incomplete_data)[0]:
+            self._log("_isVisit start {0} end {1} duration {2} incomplete data {3}: ".format( 
+                      starts[k], stops[k], duration[k], incomplete_data[k]))
         
-        if is_pause:
-            self._log("Detected pause between {0} and {1} of length {2}".format(start_index, stop, duration))
-            
-        if duration < location_parameters["min_time"] and is_pause:
-            return None
+        # Short visits with incomplete data are invalidated (unless they are pauses)
+        dropped = short & incomplete_data & ~is_pause
+        self._fill_ranges(self.is_valid, starts[dropped], stops[dropped], 0)
         
-        visit_is_valid = True
-        if duration < location_parameters["min_time"] and not incomplete_data:
-            visit_is_valid = False
-            self._log("_isVisit start {0} end {1} duration {2} incomplete data {3}: ".format( 
-                  start_index, stop, duration, incomplete_data))
-            
-        if duration < location_parameters["min_time"] and incomplete_data:
-            self.is_valid[start_index:stop] = 0
+        keep = ~short | ~(is_pause | incomplete_data)
+        starts, stops, duration = starts[keep], stops[keep], duration[keep]
+        n = starts.shape[0]
+        if n == 0:
             return
-            
-        if duration < 1.:
-            duration = 1.
-        
-        lats = self.latitudes[start_index:stop]
-        lons = self.longitudes[start_index:stop]
-        cm_lat = np.mean( lats )
-        cm_lon = np.mean( lons )
-        
-        radius = max([self.g.compute_distance(lat, lon, cm_lat, cm_lon) for (lat,lon) in zip(lats, lons) ] )
-        if (radius <= location_parameters["radius"]) or True:
-            cl = Visit(self.visitCounter, cm_lat, cm_lon, radius, duration, start_index, stop)
-            cl.is_valid = visit_is_valid
-            cl.distanceFromHome(self)
-            cl.distanceFromStore(self)
-            self.visitCounter+=1
-            return cl
-        else:
-            if self.g.compute_distance(lats[0], lons[0], cm_lat, cm_lon) > self.g.compute_distance(lats[-1], lons[-1], cm_lat, cm_lon):
-                return self._isVisit(start_index+1, stop, location_parameters)
-            else:
-                return self._isVisit(start_index, stop-1, location_parameters)
-            
+        visit_is_valid = ~short[keep]
+        duration[duration < 1.] = 1.
+        
+        visit, index, offsets, lengths = self._trip_fixes(starts, stops-1)
+        
+        cm_lat = np.add.reduceat(self.latitudes[index], offsets)/lengths
+        cm_lon = np.add.reduceat(self.longitudes[index], offsets)/lengths
+        fd = self.fix_distances()
+        radius = np.maximum.reduceat(fd.to_point(index, cm_lat[visit], cm_lon[visit]), offsets)
+        
+        # Visit.distanceFromHome for all the visits
+        home_mean = np.add.reduceat(self.is_home[index].astype(np.float64), offsets)/lengths
+        is_home = ((home_mean > 0.5) | (self.is_home[starts] != 0) | (self.is_home[stops-1] != 0)).astype(np.int8)
+        self._fill_ranges(self.is_home, starts, stops, is_home)
+        dist_from_home = np.zeros(n)
+        home_lat, home_lon = self.home_at(starts)
+        away = is_home == 0
+        dist_from_home[away & np.isnan(home_lat)] = np.nan
+        away &= ~np.isnan(home_lat)
+        if np.any(away):
+            dist_from_home[away] = fd.points(cm_lat[away], cm_lon[away], home_lat[away], home_lon[away])
+        
+        columns = {}
+        if self.store_id is not None:
+            # Visit.distanceFromStore for all the visits: most frequent store id of the visit
+            stores, _ = self._segment_majority(self.store_id[index], visit, n, lengths)
+            at_store = stores > -1
+            stores[~at_store] = -1
+            # Marker of a store: that of the fixes marked with its id
+            visited, first = np.unique(self.store_id[index], return_index=True)
+            markers = self.store_marker[index[first]]
+            store_marker = -np.ones(n, dtype=np.int8)
+            store_marker[at_store] = markers[np.searchsorted(visited, stores[at_store])]
+            columns["store_id"]     = stores
+            columns["store_marker"] = store_marker
+        
+        self.visits.extend(id=np.arange(self.visitCounter, self.visitCounter + n), cm_lat=cm_lat, cm_lon=cm_lon,
+                           radius=radius, duration=duration, first_index=starts, stop=stops,
+                           is_valid=visit_is_valid, is_home=is_home, dist_from_home=dist_from_home, **columns)
+        self.visitCounter += n
+        
+        # Place of the visit in each geofence layer: most frequent place id, as for stores
+        for name, place in self.geofences.items():
+            ids, _ = self._segment_majority(place[index], visit, n, lengths)
+            self.visits.geofences[name] = np.concatenate( (self.visits.geofences.get(name, ids[:0]), ids) )
             
     def _merge_visits_into_locations(self, visits, radius):
         assert len(self.locations) == 0
         
-        locationAlreadyVisited = False
+        # A visit can only merge into locations whose centroid is within radius + visit.radius/2
+        # (see Location.merge); the candidates are tried in the order the locations were created
+        grid = LocationGrid(radius)
         for visit in visits:
-            for loc in self.locations:
+            locationAlreadyVisited = False
+            for row in grid.candidates(visit.cm_lat, visit.cm_lon, radius + .5*visit.radius):
+                loc = self.locations[row]
+                old_lat, old_lon = loc.cm_lat, loc.cm_lon
                 locationAlreadyVisited = loc.merge(visit,self,radius)
                 if locationAlreadyVisited:
+                    grid.move(row, old_lat, old_lon, loc.cm_lat, loc.cm_lon)
                     break
             if not locationAlreadyVisited:
                 self.locations.append(Location(self.locationCounter, visit, self))
+                grid.insert(len(self.locations)-1, visit.cm_lat, visit.cm_lon)
                 self.locationCounter+=1
                 
                 
     def get_distance(self,i,j):
-        fix_i = self._getFix(i)
-        fix_j = self._getFix(j)
-        
-        return self.g.compute_distance_t(fix_i.coords, fix_j.coords) 
+        return self.fix_distances().between(i, j)
 
     def _log(self, *args):
         if self.logging:
@@ -578,3 +805,27 @@ class GPSData:
             if self.is_last_fix[i]==1 and self.is_valid[i] == 0:
                 self.is_last_fix[i] = 0
                 self.is_last_fix[i-1] = 1
+
+
+def segmentExecutor(trip_parameters):
+    """
+    Process pool for GPSData.trip_detection with trip_parameters["workers"] processes,
+    or None (serial) if it is 0. The per-segment work is vectorized, so the serial path
+    is usually faster unless the participants have many long segments.
+    Shut the pool down when all the participants are processed.
+    """
+    if trip_parameters["workers"] > 0:
+        return ProcessPoolExecutor(max_workers=trip_parameters["workers"])
+    return None
+
+def _segment_trips(args):
+    """
+    States and candidate trips of one segment (see GPSData._segment)
+    """
+    data, trip_parameters = args
+    n = data.timestamps.shape[0]
+    data.state       = -np.ones(n, dtype=np.int8)
+    data.trip_marker = -np.ones(n, dtype=np.int32)
+    data._define_state(0, n, trip_parameters)
+    starts, ends = data._trip_candidates(0, n)
+    return data.state, starts, ends
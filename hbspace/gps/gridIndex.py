@@ -0,0 +1,60 @@
+# 
+# This file is part of the Health Behavior in Space software (https://github.com/dsalvolab/hbspace).
+# Copyright (c) 2022 Umberto Villa.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import numpy as np
+
+METERS_PER_DEGREE = 110574.   # Lower bound over the ellipsoid (meridian degree at the equator)
+
+def degrees_within(distance, lat=0.):
+    """
+    Upper bound (with a 10% margin) of the extent in degrees of a distance (meters)
+    at latitudes up to |lat|: for latitude use lat=0.
+    """
+    return 1.1*distance/(METERS_PER_DEGREE*np.cos(np.radians(min(abs(lat), 89.))))
+
+def expand_ranges(starts, stops):
+    """
+    Concatenation of the ranges starts[k]:stops[k]: range number and value of each entry,
+    plus offset and length of each range in the concatenation (for reduceat)
+    """
+    lengths = stops - starts
+    offsets = np.cumsum(lengths) - lengths
+    segment = np.repeat(np.arange(starts.shape[0]), lengths)
+    index   = starts[segment] + np.arange(segment.shape[0]) - offsets[segment]
+    return segment, index, offsets, lengths
+
+
+class GridCells:
+    """
+    Square cells of cell degrees in the (latitude, longitude) plane, identified by int64 keys
+    """
+    OFFSET = 2**30
+    
+    def __init__(self, cell):
+        self.cell = cell
+        
+    def cells(self, lats, lons):
+        return (np.floor(lats/self.cell).astype(np.int64) + self.OFFSET,
+                np.floor(lons/self.cell).astype(np.int64) + self.OFFSET)
+    
+    @staticmethod
+    def key(i, j):
+        return (i << 32) + j
+    
+    def keys(self, lats, lons):
+        return self.key(*self.cells(lats, lons))
@@ -16,11 +16,30 @@
 #
 
 import numpy as np
-import scipy.stats as sstats
 from .trip import trip_mode
+from .tables import Column, EntityTable, EntityView
+from .gridIndex import METERS_PER_DEGREE, degrees_within, expand_ranges
 
-class Visit:
+class Visit(EntityView):
+    """
+    A visit, stored as a row of a VisitTable
+    """
+    id             = Column(np.int32, none=-1)
+    cm_lat         = Column(np.float64, none=np.nan)
+    cm_lon         = Column(np.float64, none=np.nan)
+    radius         = Column(np.float64, none=np.nan)
+    duration       = Column(np.float64, none=np.nan)
+    first_index    = Column(np.int64, none=-1)
+    stop           = Column(np.int64, none=-1)
+    locationId     = Column(np.int32, none=-1)
+    is_valid       = Column(np.int8, none=-1, boolean=True)
+    is_home        = Column(np.int8, none=-1)
+    store_id       = Column(np.int32, none=-2, empty=-1)
+    store_marker   = Column(np.int8, none=-2, empty=-1)
+    dist_from_home = Column(np.float64, none=np.nan)
+    
     def __init__(self, id, cm_lat, cm_lon, radius, duration, first_index, stop):
+        self._init_row()
         self.duration = duration
         self.cm_lat   = cm_lat
         self.cm_lon   = cm_lon
@@ -31,15 +50,6 @@ class Visit:
         
         self.id = id
         
-        self.locationId = None
-        self.is_valid   = None
-        
-        self.is_home        = None
-        self.store_id       = None
-        self.store_marker   = None
-        
-        self.dist_from_home = None
-        
     def distanceFromHome(self, data):
         if data.is_home is not None:
             is_home = data.is_home[self.first_index : self.stop]
@@ -52,15 +62,18 @@ class Visit:
         if self.is_home == 1:
             self.dist_from_home = 0.
         else:
-            cm_coords = (self.cm_lat, self.cm_lon)
-            self.dist_from_home = data.g.compute_distance_t(cm_coords, data.home_coords)
+            home_lat, home_lon = data.home_at(self.first_index)
+            if np.isnan(home_lat):
+                self.dist_from_home = None
+            else:
+                self.dist_from_home = data.fix_distances().points(self.cm_lat, self.cm_lon, home_lat, home_lon)
             
     def distanceFromStore(self, data):
         if data.store_id is not None:
-            store_id = data.store_id[self.first_index : self.stop]
-            mode = sstats.mode(store_id, axis=None)
-            my_store = mode[0][0]
-            if my_store > -1 and np.mean(store_id == store_id)>0.5:
+            # Most frequent store id (the smallest in case of ties)
+            stores, counts = np.unique(data.store_id[self.first_index : self.stop], return_counts=True)
+            my_store = stores[np.argmax(counts)]
+            if my_store > -1:
                 self.store_id = my_store
                 self.store_marker = data.store_maps_coords[my_store][2]
             else:
@@ -72,22 +85,14 @@ class Visit:
         if arrival_trip_id == -1:
             return ""
         
-        for t in data.trips:
-            if t.id == arrival_trip_id:
-                return t.departedHome(data)
-            
-        raise
+        return data.trips.find(arrival_trip_id).departedHome(data)
     
     def _didDepartingTripArrivedHome(self, data):
         dept_trip_id = data.trip_marker[ self.stop - 1 ]
         if dept_trip_id == -1:
             return ""
         
-        for t in data.trips:
-            if t.id == dept_trip_id:
-                return t.arrivedHome(data)
-            
-        raise
+        return data.trips.find(dept_trip_id).arrivedHome(data)
                 
         
         
@@ -105,10 +110,10 @@ class Visit:
         out["longitude"]    = self.cm_lon
         out["radius"]       = self.radius
         out["duration"]     = self.duration/60.
-        out["visit_start_date"]  = data.local_datetime[self.first_index].strftime('%Y-%m-%d')
-        out["visit_start_time"]  = data.local_datetime[self.first_index].strftime('%H:%M:%S')
-        out["visit_end_date"]    = data.local_datetime[self.stop-1].strftime('%Y-%m-%d')
-        out["visit_end_time"]    = data.local_datetime[self.stop-1].strftime('%H:%M:%S')
+        out["visit_start_date"]  = data.local_date(self.first_index)
+        out["visit_start_time"]  = data.local_time(self.first_index)
+        out["visit_end_date"]    = data.local_date(self.stop-1)
+        out["visit_end_time"]    = data.local_time(self.stop-1)
         out["arrival_mode"] = trip_mode[ data.trip_type[self.first_index ] ]
         if data.trip_marker[ self.first_index ] >= 0:
             out["arrival_trip_id"] = data.trip_marker[ self.first_index ]+1
@@ -137,6 +142,9 @@ class Visit:
             out["store_id"] = self.store_id
             out["is_fresh_store"] = self.store_marker
             
+        for name, place in self._table.geofences.items():
+            out[name+"_id"] = place[self._row] if place[self._row] > -1 else ""
+            
         return out
         
     @classmethod
@@ -160,7 +168,10 @@ class Visit:
                 ]
         
     @classmethod
-    def infoKeysExt(self):
+    def infoKeysExt(self, geofences=()):
+        """
+        geofences: names of the geofence layers (see GPSData.mark_geofences)
+        """
         return [
                 "partid",                 #Participant ID
                 "locationid",             #Trip ID
@@ -183,22 +194,34 @@ class Visit:
                 "is_fresh_store",
                 "came_from_home",
                 "went_home"
-                ]
+                ] + [name+"_id" for name in geofences]  # Place of the visit in each geofence layer
 
-class Location:
+class Location(EntityView):
+    """
+    A location, stored as a row of a LocationTable.
+    The visits of the location are the rows of the VisitTable with locationId == id.
+    """
+    id             = Column(np.int32, none=-1)
+    cm_lat         = Column(np.float64, none=np.nan)
+    cm_lon         = Column(np.float64, none=np.nan)
+    radius         = Column(np.float64, none=np.nan)
+    nvisits        = Column(np.int32)
+    is_home        = Column(np.int8, none=-1)
+    store_id       = Column(np.int32, none=-2, empty=-1)
+    store_marker   = Column(np.int8, none=-2, empty=-1)
+    dist_from_home = Column(np.float64, none=np.nan)
+    ntimes_arriving_trip_originated_from_home = Column(np.int32)
+    ntimes_departing_trip_arrived_at_home     = Column(np.int32)
+    total_duration = Column(np.float64)
+    home_duration  = Column(np.float64)   # Total duration of the visits with a distance from home
+    
     def __init__(self, id, visit, data):
         if visit is None:
             return
         else:
+            self._table = LocationTable(data.visits, 1)
+            self._row   = self._table.new_row()
             self.id = id
-            self.duration = [visit.duration]
-#           self.cm_lats = [candidateLocation.cm_lat]
-#           self.cm_lons = [candidateLocation.cm_lon]
-#           self.radiuses = [candidateLocation.radius]
-            self.first_indexes  = [visit.first_index]
-            self.stops          = [visit.stop]
-            self.visit_ids      = [visit.id]
-            self.visit_is_valid = [visit.is_valid]
             
             assert visit.is_valid is not None
         
@@ -206,11 +229,15 @@ class Location:
             self.cm_lon = visit.cm_lon
             self.radius = visit.radius
             self.nvisits = 1
+            self.total_duration = visit.duration
+            self._table.fixes[self._row] = LocationFixes(np.arange(visit.first_index, visit.stop),
+                                                         visit.cm_lat, visit.cm_lon, data)
             
             self.is_home        = visit.is_home
             self.store_id       = visit.store_id
             self.store_marker   = visit.store_marker
             self.dist_from_home = visit.dist_from_home
+            self.home_duration  = visit.duration if visit.dist_from_home is not None else 0.
             
             self.ntimes_arriving_trip_originated_from_home = 0
             self.ntimes_departing_trip_arrived_at_home     = 0
@@ -222,6 +249,32 @@ class Location:
                 self.ntimes_departing_trip_arrived_at_home += 1
             
             visit.locationId = id
+            
+    def _visit_rows(self):
+        return np.where(self._table.visits.column("locationId") == self.id)[0]
+    
+    def _visit_column(self, name):
+        return self._table.visits.column(name)[self._visit_rows()].tolist()
+        
+    @property
+    def duration(self):
+        return self._visit_column("duration")
+    
+    @property
+    def first_indexes(self):
+        return self._visit_column("first_index")
+    
+    @property
+    def stops(self):
+        return self._visit_column("stop")
+    
+    @property
+    def visit_ids(self):
+        return self._visit_column("id")
+    
+    @property
+    def visit_is_valid(self):
+        return [v == 1 for v in self._visit_column("is_valid")]
         
     def merge(self, other, data, radius):
         """
@@ -231,7 +284,7 @@ class Location:
         assert other.locationId is None
         assert other.is_valid is not None
         
-        cm_dist = data.g.compute_distance(self.cm_lat, self.cm_lon, other.cm_lat, other.cm_lon)
+        cm_dist = data.fix_distances().points(self.cm_lat, self.cm_lon, other.cm_lat, other.cm_lon)
         
         if cm_dist > radius - .5*(self.radius - other.radius):
             return False #Quick return if locations are far away
@@ -243,34 +296,26 @@ class Location:
             return False
         
         # Do the math
-        cum_dur = np.sum(self.duration)
+        cum_dur = self.total_duration
         new_cm_lat = (cum_dur*self.cm_lat + other.duration*other.cm_lat)/(cum_dur + other.duration)
         new_cm_lon = (cum_dur*self.cm_lon + other.duration*other.cm_lon)/(cum_dur + other.duration)
         
-        lats = []
-        lons = []
-        for i in range(self.nvisits):
-            [lats.append(lat) for lat in data.latitudes[self.first_indexes[i]:self.stops[i]] ]
-            [lons.append(lon) for lon in data.longitudes[self.first_indexes[i]:self.stops[i] ] ]
-            
-        [lats.append(lat) for lat in data.latitudes[other.first_index:other.stop] ]
-        [lons.append(lon) for lon in data.longitudes[other.first_index:other.stop] ]
+        # The fixes of the new visit alone may already exceed the radius
+        fd = data.fix_distances()
+        other_index = np.arange(other.first_index, other.stop)
+        new_radius = np.max( fd.to_point(other_index, new_cm_lat, new_cm_lon) )
+        if new_radius > radius:
+            return False
         
-        new_radius = max([data.g.compute_distance(lat, lon, new_cm_lat, new_cm_lon) for (lat,lon) in zip(lats, lons) ] )
+        fixes = self._table.fixes[self._row]
+        new_radius = fixes.max_distance(new_cm_lat, new_cm_lon, new_radius, radius, data)
         
         if new_radius <= radius:
-            self.duration.append(other.duration)
-#            self.cm_lats.append(other.cm_lat)
-#            self.cm_lons.append(other.cm_lon)
-#            self.radiuses.append(other.radius)
-            self.first_indexes.append(other.first_index)
-            self.stops.append(other.stop)
-            self.visit_ids.append(other.id)
-            self.visit_is_valid.append(other.is_valid)
-            
             self.cm_lat = new_cm_lat
             self.cm_lon = new_cm_lon
             self.radius = new_radius
+            self.total_duration = cum_dur + other.duration
+            fixes.add(other_index, new_cm_lat, new_cm_lon, radius, data)
             
             if other._didArrivingTripDepartedHome(data) == 1:
                 self.ntimes_arriving_trip_originated_from_home += 1
@@ -279,7 +324,15 @@ class Location:
                 self.ntimes_departing_trip_arrived_at_home += 1
             
             
-            self.dist_from_home = (cum_dur*self.dist_from_home + other.duration*self.dist_from_home)/(cum_dur + other.duration)
+            # Duration-weighted average over the visits with a distance from home
+            # (visits not covered by a home period have none)
+            if other.dist_from_home is not None:
+                home_dur = self.home_duration
+                if self.dist_from_home is None:
+                    self.dist_from_home = other.dist_from_home
+                else:
+                    self.dist_from_home = (home_dur*self.dist_from_home + other.duration*other.dist_from_home)/(home_dur + other.duration)
+                self.home_duration = home_dur + other.duration
             
             other.locationId = self.id
         
@@ -305,7 +358,7 @@ class Location:
         out["radius"]     = self.radius
         out["avg_stay"]   = np.mean(self.duration)/60.
         
-        ind_val = np.array(self.visit_is_valid, dtype=np.int)
+        ind_val = np.array(self.visit_is_valid, dtype=np.int8)
         duration = np.array(self.duration)
         if np.any(ind_val > 0):
             out["avg_stay_validVisit"]   = np.mean(duration[ind_val > 0])/60.
@@ -356,4 +409,211 @@ class Location:
                 "is_fresh_store",
                 "number_of_times_came_from_home",
                 "number_of_times_went_home"
-                ]
\ No newline at end of file
+                ]
+
+
+class LocationFixes:
+    """
+    Indexes of the fixes of the visits of a location, with their distances (ref_dist)
+    from a reference point (ref_lat, ref_lon) close to the centroid.
+    By the triangle inequality, the distance of a fix from the centroid differs from ref_dist
+    at most by the distance (shift) between the reference point and the centroid.
+    Each visit is a chunk of the arrays with the largest ref_dist of its fixes (chunk_max),
+    so that a merge attempt only looks at the visits whose fixes can be the farthest.
+    The arrays grow by doubling their capacity; size entries are in use.
+    """
+    def __init__(self, index, ref_lat, ref_lon, data):
+        self.size       = 0
+        self.nchunks    = 0
+        self._index     = np.zeros(max(2*index.shape[0], 16), dtype=np.int64)
+        self._ref_dist  = np.zeros(self._index.shape[0])
+        self._offsets   = np.zeros(16, dtype=np.int64)    # Chunk k is offsets[k]:offsets[k+1]
+        self._chunk_max = np.zeros(16)
+        self._push(index)
+        self._rebase(ref_lat, ref_lon, data)
+        
+    @property
+    def index(self):
+        return self._index[:self.size]
+    
+    @property
+    def ref_dist(self):
+        return self._ref_dist[:self.size]
+    
+    @staticmethod
+    def _grow(array, size):
+        if size <= array.shape[0]:
+            return array
+        out = np.zeros(max(size, 2*array.shape[0]), dtype=array.dtype)
+        out[:array.shape[0]] = array
+        return out
+    
+    def _push(self, index):
+        size = self.size + index.shape[0]
+        self._index    = self._grow(self._index, size)
+        self._ref_dist = self._grow(self._ref_dist, size)
+        self._index[self.size:size] = index
+        self._offsets   = self._grow(self._offsets, self.nchunks + 2)
+        self._chunk_max = self._grow(self._chunk_max, self.nchunks + 1)
+        self._offsets[self.nchunks + 1] = size
+        self.size = size
+        self.nchunks += 1
+        
+    def _rebase(self, ref_lat, ref_lon, data):
+        self.ref_lat  = ref_lat
+        self.ref_lon  = ref_lon
+        self._ref_dist[:self.size] = data.fix_distances().to_point(self.index, ref_lat, ref_lon)
+        self._chunk_max[:self.nchunks] = np.maximum.reduceat(self.ref_dist, self._offsets[:self.nchunks])
+        self.max_ref_dist = np.max(self._chunk_max[:self.nchunks])
+        
+    def max_distance(self, lat, lon, lower, radius, data):
+        """
+        Largest distance of the fixes from (lat, lon), or of lower if larger.
+        Fixes that cannot exceed lower are skipped; return np.inf if a fix is
+        known to be farther than radius without computing the distances.
+        """
+        fd = data.fix_distances()
+        shift = fd.points(self.ref_lat, self.ref_lon, lat, lon)
+        tol = 1e-3*radius   # Allow for the rounding/approximation errors of the distance backend
+        if self.max_ref_dist - shift > radius + tol:
+            return np.inf
+        chunks = np.where(self._chunk_max[:self.nchunks] + shift + tol >= lower)[0]
+        if chunks.shape[0]:
+            _, pos, _, _ = expand_ranges(self._offsets[chunks], self._offsets[chunks+1])
+            pos = pos[self._ref_dist[pos] + shift + tol >= lower]
+            if pos.shape[0]:
+                lower = max(lower, np.max( fd.to_point(self._index[pos], lat, lon) ))
+        return lower
+    
+    def add(self, index, lat, lon, radius, data):
+        """
+        Add the fixes index (of a visit) to the location, whose centroid is now (lat, lon)
+        """
+        if index.shape[0] == 0:
+            return
+        start = self.size
+        self._push(index)
+        fd = data.fix_distances()
+        if fd.points(self.ref_lat, self.ref_lon, lat, lon) > .25*radius:
+            self._rebase(lat, lon, data)
+        else:
+            d = fd.to_point(index, self.ref_lat, self.ref_lon)
+            self._ref_dist[start:self.size] = d
+            self._chunk_max[self.nchunks-1] = np.max(d)
+            self.max_ref_dist = max(self.max_ref_dist, self._chunk_max[self.nchunks-1])
+
+
+class LocationGrid:
+    """
+    Uniform grid over the centroids of the locations, to find the locations
+    that can be within a given distance (meters) of a point.
+    Longitude cells are sized with the cosine of the largest absolute latitude covered
+    (max_lat), so that they are at most cell meters wide; the grid is rebuilt when a
+    point falls outside the covered latitudes.
+    """
+    def __init__(self, cell):
+        self.cell    = max(float(cell), 1.)
+        self.cells   = {}
+        self.centers = {}    # row -> (lat, lon)
+        self.max_lat = -1.
+        self.cos_lat = 1.
+        
+    def _cover(self, lat, distance=0.):
+        lat = abs(lat) + degrees_within(distance)
+        if lat > self.max_lat:
+            self.max_lat = min(lat + 1., 90.)
+            self.cos_lat = max(np.cos(np.radians(self.max_lat)), 1e-6)
+            self.cells = {}
+            for row, (clat, clon) in self.centers.items():
+                self.cells.setdefault(self._key(clat, clon), []).append(row)
+        
+    def _key(self, lat, lon):
+        return (int(np.floor(lat*METERS_PER_DEGREE/self.cell)),
+                int(np.floor(lon*METERS_PER_DEGREE*self.cos_lat/self.cell)))
+        
+    def insert(self, row, lat, lon):
+        self._cover(lat)
+        self.centers[row] = (lat, lon)
+        self.cells.setdefault(self._key(lat, lon), []).append(row)
+        
+    def move(self, row, old_lat, old_lon, lat, lon):
+        self._cover(lat)
+        old_key = self._key(old_lat, old_lon)
+        new_key = self._key(lat, lon)
+        self.centers[row] = (lat, lon)
+        if old_key != new_key:
+            self.cells[old_key].remove(row)
+            self.cells.setdefault(new_key, []).append(row)
+        
+    def candidates(self, lat, lon, distance):
+        """
+        Sorted rows of the locations whose centroid may be within distance of (lat, lon)
+        (with a 10% margin for the approximation of the distance in degrees)
+        """
+        self._cover(lat, distance)
+        ki, kj = self._key(lat, lon)
+        r = int(np.ceil(1.1*distance/self.cell)) + 1
+        out = []
+        for i in range(ki - r, ki + r + 1):
+            for j in range(kj - r, kj + r + 1):
+                out += self.cells.get((i, j), [])
+        return sorted(out)
+        
+
+class VisitTable(EntityTable):
+    """
+    Columns of all the visits of a participant (or of a cohort, see concatenate).
+    geofences maps the name of each geofence layer to the place id of each visit (-1: none).
+    """
+    VIEW = Visit
+    
+    def __init__(self, capacity=16):
+        EntityTable.__init__(self, capacity)
+        self.geofences = {}
+        
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        Concatenate tables (e.g. of different participants) in a new table;
+        visits of a table without a geofence layer get -1 (none) for that layer
+        """
+        out = super(VisitTable, cls).concatenate(tables)
+        names = []
+        for t in tables:
+            names += [name for name in t.geofences if name not in names]
+        out.geofences = {name: np.concatenate([t.geofences.get(name, -np.ones(len(t), dtype=np.int64))
+                                               for t in tables]) for name in names}
+        return out
+    
+Visit.TABLE = VisitTable
+
+
+class LocationTable(EntityTable):
+    """
+    Columns of all the locations of a participant. visits is the VisitTable
+    of the visits assigned to the locations (see Visit.locationId).
+    """
+    VIEW = Location
+    
+    def __init__(self, visits, capacity=16):
+        EntityTable.__init__(self, capacity)
+        self.visits = visits
+        self.fixes  = {}    # row -> LocationFixes, used by Location.merge
+        
+    def append(self, view):
+        fixes = view._table.fixes.get(view._row)
+        EntityTable.append(self, view)
+        if fixes is not None:
+            self.fixes[view._row] = fixes
+        
+    @classmethod
+    def concatenate(cls, tables, visits=None):
+        """
+        Concatenate tables (e.g. of different participants); visits is the
+        concatenation of their VisitTable. Ids must be unique across the tables,
+        as when tripCounter, visitCounter and locationCounter carry over participants.
+        """
+        out = super(LocationTable, cls).concatenate(tables)
+        out.visits = visits
+        out.fixes  = {}
+        return out
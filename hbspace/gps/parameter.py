@@ -27,6 +27,7 @@ def invalidFixesDefaults():
     parameters.add_param("max_sloss",   600., "Max loss of signal allowed (seconds)" )
     parameters.add_param("rm_lone",    True, "Remove lone fixes between SLOSSes")
     parameters.add_param("rm_sparse",    True, "Remove short intervals <3 min between SLOSSes")
+    parameters.add_param("engine", "vectorized", "Filter implementation: vectorized, legacy, check (run both and compare)")
     return parameters
     
 def locationDetectionDefaults():
@@ -39,7 +40,8 @@ def locationDetectionDefaults():
     
 def tripDetectionDefaults():
     parameters = ParameterList() 
-    parameters.add_param("min_dist",      10, "Minimum distance traveled over 1 minute (meters)")
+    parameters.add_param("min_dist",      10, "Minimum distance traveled over the lookback window (meters)")
+    parameters.add_param("lookback",      60, "Lookback window to measure the distance traveled (seconds)")
     parameters.add_param("min_length",   100, "Minimum trip length (meters)")
     parameters.add_param("radius",       30., "Cluster radius (meters)")
     parameters.add_param("min_dur",      180, "Minimum trip duration (seconds)")
@@ -47,6 +49,7 @@ def tripDetectionDefaults():
     parameters.add_param("max_pause",    300, "Maximum pause time (seconds)")
     parameters.add_param("min_avg_speed",1.5, "Minimum avg speed (Km/h)")   #ADDED
     parameters.add_param("single_loc", False, "Allow trips within a single location") #UNUSED!
+    parameters.add_param("workers",        0, "Processes for the segments between losses of signal (0: serial)")
     return parameters
 
 def speedCutoffDefaults():
@@ -57,11 +60,18 @@ def speedCutoffDefaults():
     #parameters.add_param("slow_walk", [ 0., 1.  ],  "Sedentary speed cutoff value (Km/hour)") #REMOVED!
     return parameters 
 
+def distanceDefaults():
+    parameters = ParameterList()
+    parameters.add_param("backend", None, "Distance backend: geopy, pyproj, haversine, tangent_plane (None: pyproj if available)")
+    parameters.add_param("project", False, "Project the fixes once to UTM coordinates (meters) and use Euclidean distances")
+    return parameters
+
 def defaultParameters():
     parameters = ParameterList() 
     parameters.add_param("invalid_fixes", invalidFixesDefaults(), "Filter invalid values")
     parameters.add_param("location", locationDetectionDefaults(), "Location detection")
     parameters.add_param("trip", tripDetectionDefaults(), "Trip detection")
     parameters.add_param("speed", speedCutoffDefaults(), "Speed cutoff values")
+    parameters.add_param("distance", distanceDefaults(), "Distance computation")
     return parameters
     
\ No newline at end of file
@@ -33,19 +33,23 @@ if has_pyproj:
         return ((ref_long + 180)//6 % 60) + 1
 
     class UTMprojection:
-        def __init__(self, zone, ellps='WGS84'):
-            self.p = Proj(proj='utm',zone=zone,ellps=ellps)
+        def __init__(self, zone, ellps='WGS84', south=False):
+            self.zone = zone
+            self.p = Proj(proj='utm',zone=zone,ellps=ellps, south=south)
         
         def get_xy(self, lat, lon):
-            return self.p(lat, lon)
+            return self.p(lon, lat)
     
         def get_xys(self, lats, lons):
-            npoints = lats.shape[0]
+            """
+            Project whole arrays of coordinates at once. Returns eastings and northings (meters).
+            """
+            x, y = self.p(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+            return np.asarray(x), np.asarray(y)
         
-            x = np.zeros_like(lats)
-            y = np.zeros_like(lats)
-        
-            for i in np.arange(npoints):
-                x[i], y[i] = self.p(lats[i], lons[i])
-            
-            return x,y
\ No newline at end of file
+    def utm_projection(lats, lons, ellps='WGS84'):
+        """
+        UTM projection for the zone (and hemisphere) containing the median of the fixes
+        """
+        zone = int( get_zone( np.median(lons) ) )
+        return UTMprojection(zone, ellps, south = np.median(lats) < 0.)
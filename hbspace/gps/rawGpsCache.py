@@ -0,0 +1,121 @@
+# 
+# This file is part of the Health Behavior in Space software (https://github.com/dsalvolab/hbspace).
+# Copyright (c) 2022 Umberto Villa.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import hashlib
+
+import numpy as np
+
+class RawGPSCache:
+    """
+    On-disk cache of the parsed (sorted and de-duplicated) columns of raw GPS files.
+    
+    Each entry is an uncompressed .npz archive keyed by the content hash of the source file.
+    The hash is kept in a .stamp file with the size and modification time of the source, and
+    the content is hashed again only when they change. When the total size of the cache
+    exceeds max_size (bytes) the least recently used entries are evicted.
+    """
+    
+    VERSION = 1
+    
+    COLUMNS = ['timestamps', 'latitudes', 'longitudes',
+               'elevations', 'speeds', 'headings', 'source_index',
+               'conflicting_duplicates', 'unordered_source']
+    
+    def __init__(self, folder, max_size=2**30):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(folder, exist_ok=True)
+        
+    def key(self, fname):
+        st = os.stat(fname)
+        fingerprint = "{0}|{1}".format(st.st_size, st.st_mtime_ns)
+        stamp = os.path.join(self.folder,
+                             hashlib.sha1(os.path.abspath(fname).encode()).hexdigest() + ".stamp")
+        
+        digest = None
+        if os.path.exists(stamp):
+            with open(stamp) as fid:
+                fields = fid.read().split()
+            if len(fields) == 2 and fields[0] == fingerprint:
+                digest = fields[1]
+        
+        if digest is None:
+            content = hashlib.sha1()
+            with open(fname, 'rb') as fid:
+                for block in iter(lambda: fid.read(2**20), b''):
+                    content.update(block)
+            digest = content.hexdigest()
+            with open(stamp, "w") as fid:
+                fid.write("{0} {1}\n".format(fingerprint, digest))
+        
+        key = "{0}|{1}".format(self.VERSION, digest)
+        return hashlib.sha1(key.encode()).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.folder, key + ".npz")
+        
+    def load(self, key):
+        """
+        Return the dictionary of cached columns for key, or None on a cache miss
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        
+        try:
+            with np.load(path) as entry:
+                columns = {c: entry[c] for c in self.COLUMNS}
+        except Exception:
+            os.remove(path)
+            return None
+        
+        os.utime(path)
+        return columns
+    
+    def store(self, key, columns):
+        path = self._path(key)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **{c: columns[c] for c in self.COLUMNS})
+        os.replace(tmp_path, path)
+        self._evict()
+        
+    def clear(self):
+        for f, _, _ in self._entries():
+            os.remove(f)
+        for f in os.listdir(self.folder):
+            if f.endswith(".stamp"):
+                os.remove(os.path.join(self.folder, f))
+        
+    def _entries(self):
+        entries = []
+        for f in os.listdir(self.folder):
+            if f.endswith(".npz") and not f.endswith(".tmp.npz"):
+                path = os.path.join(self.folder, f)
+                st = os.stat(path)
+                entries.append( (path, st.st_mtime, st.st_size) )
+        return entries
+        
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total_size = sum(e[2] for e in entries)
+        for path, _, size in entries[:-1]:
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
@@ -19,40 +19,146 @@ import os
 
 import pandas
 import numpy as np
-from .distance import GeodesicDistance
+from .distance import GeodesicDistance, FixDistances
+from . import projection
 from ..common.conversions import meter_per_second_to_km_per_hour,\
     km_per_hour_to_meter_per_second
     
 from .gpsData import GPSData, Fix
 
-import datetime
 
-def my_date_parser(strdate, strtime):
-    assert hasattr(strdate, 'shape')
-    out = np.empty(strdate.shape, dtype = datetime.datetime)
-    for ii in np.arange(strdate.shape[0]):
-        str_datetime = strdate[ii] + " " + strtime[ii]
-        if ii == 0:
-            print(str_datetime)
-        try:
-            out[ii] = datetime.datetime.strptime(str_datetime, "%Y/%m/%d %H:%M:%S")
-        except:
-            try:
-                out[ii] = datetime.datetime.strptime(str_datetime, "%m/%d/%Y %H:%M:%S")
-            except:
-                out[ii] = datetime.datetime.strptime(str_datetime, "%m%/%d/%y %H:%M:%S")
+DATETIME_FORMATS = ("%Y/%m/%d %H:%M:%S", "%m/%d/%Y %H:%M:%S", "%m/%d/%y %H:%M:%S")
+
+def detect_datetime_format(str_datetime, nsamples=10):
+    """
+    Return the format in DATETIME_FORMATS that parses most of the rows sampled
+    uniformly from str_datetime (pandas.Series of strings).
+    """
+    n = str_datetime.shape[0]
+    samples = np.unique( np.linspace(0, n-1, min(n, nsamples)).astype(np.int64) )
+    sample = str_datetime.iloc[samples]
+    nparsed = [pandas.to_datetime(sample, format=fmt, errors='coerce').notnull().sum()
+               for fmt in DATETIME_FORMATS]
     
-    return out
+    if max(nparsed) == 0:
+        raise ValueError("Unrecognized date format: {0}".format(str_datetime.iloc[0]))
+    
+    return DATETIME_FORMATS[int(np.argmax(nparsed))]
+
+def parse_datetimes(strdate, strtime, fmt=None):
+    """
+    Vectorized conversion of the date and time columns (pandas.Series of strings)
+    to a datetime64[s] array. Unless fmt is given, the format is detected once on
+    a sample of rows; rows that do not match it fall back on the other supported formats.
+    """
+    str_datetime = strdate.str.strip() + " " + strtime.str.strip()
+    if fmt is None:
+        fmt = detect_datetime_format(str_datetime)
+    
+    out = pandas.to_datetime(str_datetime, format=fmt, errors='coerce')
+    for other in DATETIME_FORMATS:
+        missing = out.isnull()
+        if not missing.any():
+            break
+        out[missing] = pandas.to_datetime(str_datetime[missing], format=other, errors='coerce')
+    
+    missing = out.isnull()
+    if missing.any():
+        raise ValueError("Unrecognized date format: {0}".format(str_datetime[missing].iloc[0]))
+    
+    return out.values.astype('datetime64[s]')
     
 
 class RawGPSData:
-    def __init__(self, fname, id=None, logging=False):
+    
+    # Reason why filter marked a fix as invalid (rejection array)
+    VALID            = 0
+    MAX_DIST         = 1
+    MAX_SPEED        = 2
+    MAX_D_ELEV       = 3
+    MIN_DIST         = 4
+    FIRST_MAX_DIST   = 5
+    FIRST_MAX_SPEED  = 6
+    FIRST_MAX_D_ELEV = 7
+    LAST_LONE        = 8
+    LONE             = 9
+    SPARSE           = 10
+    
+    REJECTION_REASONS = ["valid", "max_dist", "max_speed", "max_d_elev", "min_dist",
+                         "first_max_dist", "first_max_speed", "first_max_d_elev",
+                         "last_lone", "lone", "sparse"]
+    
+    def __init__(self, fname, id=None, logging=False, cache=None, chunksize=None, coords_dtype=np.float64,
+                 distance=None, project=False):
+        """
+        cache is an optional RawGPSCache. On a cache hit the CSV file is not parsed.
+        chunksize (number of rows) turns on the streaming reader for very large files.
+        coords_dtype=np.float32 halves the memory used by latitudes and longitudes
+        (about 1 meter resolution).
+        distance is the distance backend (see GeodesicDistance) used here and by the clean data.
+        project=True projects the fixes once to the local UTM zone, and all the distances
+        (here and in the clean data) are Euclidean distances between projected coordinates.
+        
+        Timestamps are int64 seconds since the epoch (local wall-clock time),
+        flags are uint8 arrays and local_datetime is derived on demand.
+        """
         self.logging = logging
         self.fname = fname
+        if distance is None:
+            distance = GeodesicDistance()
+        self.g = distance
         if id is None:
             self.id = os.path.splitext( os.path.basename(fname) )[0]
         else:
             self.id = id
+        
+        columns = None
+        if cache is not None:
+            cache_key = cache.key(fname)
+            columns = cache.load(cache_key)
+        
+        if columns is None:
+            self._read_csv(fname, chunksize)
+            self.unordered_source = False
+            self._sort_and_remove_duplicates()
+            if cache is not None:
+                cache.store(cache_key, self._columns())
+        else:
+            self._set_columns(columns)
+        
+        self.latitudes  = self.latitudes.astype(coords_dtype, copy=False)
+        self.longitudes = self.longitudes.astype(coords_dtype, copy=False)
+        
+        self.is_valid   = np.ones(self.timestamps.shape[0], dtype=np.uint8)
+        
+        self.is_first_fix = np.zeros(self.timestamps.shape[0], dtype=np.uint8)
+        self.is_first_fix[0] = 1
+        
+        self.is_last_fix = np.zeros(self.timestamps.shape[0], dtype=np.uint8)
+        self.is_last_fix[-1] = 1
+        
+        self.rejection = np.zeros(self.timestamps.shape[0], dtype=np.int8)
+        
+        self.proj = None
+        if project:
+            if not projection.has_pyproj:
+                raise ImportError("project=True requires pyproj")
+            self.proj = projection.utm_projection(self.latitudes, self.longitudes)
+        
+        self._fix_distances  = None
+        self._step_distances = None
+        
+    @property
+    def local_datetime(self):
+        return self.timestamps.astype('datetime64[s]')
+        
+    def _read_csv(self, fname, chunksize=None):
+        """
+        Read the columns used by the pipeline from the CSV file.
+        If chunksize is given, the file is streamed chunksize rows at a time
+        into preallocated typed column buffers, so that the peak memory does not
+        depend on the size of the file.
+        """
         colnames_1 = ['INDEX', 'TRACK_ID', 'VALID', 'UTC_DATE', 'UTC_TIME', 'LOCAL_DATE', 'LOCAL_TIME',
                     'MS',    'LATITUDE',   'N_S', 'LONGITUDE',     'E_W',   'ALTITUDE', 'SPEED',
                     'HEADING', 'G-X', 'G-Y', 'G-Z']
@@ -73,123 +179,180 @@ class RawGPSData:
         
         if ftype == 1:
             colnames = colnames_1
-            parse_dates={"utc_datetime": [3,4], "local_datetime": [5,6]}
+            usecols = ['local_date', 'local_time', 'latitude', 'n_s', 'longitude', 'e_w',
+                       'altitude', 'speed', 'heading']
             print("Type 1")
         else:
             colnames = colnames_2
-            parse_dates={"utc_datetime": [2,3], "local_datetime": [4,5]}
+            usecols = ['local date', 'local time', 'latitude', 'n_s', 'longitude', 'e_w',
+                       'height', 'speed', 'heading']
             print("Type 2")
             
         colnames = [name.lower() for name in colnames]
-        data = pandas.read_csv(fname, names=colnames, parse_dates=parse_dates, date_parser=my_date_parser, header=0)
+        dtype = {usecols[0]: str, usecols[1]: str}
         
-        self.timestamps = np.array([ date.timestamp() for date in  data.local_datetime ])
-        self.local_datetime = np.array([ date for date in  data.local_datetime ])
-        self.latitudes  = np.array([self._parselatitude(lat, n_s)
-                                    for (lat, n_s) in zip(data.latitude, data.n_s)])
-        self.longitudes  = np.array([self._parselongitude(lon, e_w) 
-                                    for (lon, e_w) in zip(data.longitude, data.e_w) ])
+        if chunksize is None:
+            data = pandas.read_csv(fname, names=colnames, header=0, usecols=usecols, dtype=dtype)
+            columns = self._decode(data, ftype)
+        else:
+            nrows = self._count_rows(fname)
+            columns = {"timestamps":     np.empty(nrows, dtype=np.int64),
+                       "latitudes":      np.empty(nrows),
+                       "longitudes":     np.empty(nrows),
+                       "elevations":     np.empty(nrows),
+                       "speeds":         np.empty(nrows),
+                       "headings":       np.empty(nrows)}
+            fmt = None
+            n = 0
+            for data in pandas.read_csv(fname, names=colnames, header=0, usecols=usecols, dtype=dtype,
+                                        chunksize=chunksize):
+                if fmt is None:
+                    fmt = detect_datetime_format(data[usecols[0]].str.strip() + " " + data[usecols[1]].str.strip())
+                chunk = self._decode(data, ftype, fmt)
+                m = data.shape[0]
+                if n + m > nrows:
+                    nrows = max(2*nrows, n + m)
+                    for k in columns:
+                        columns[k] = np.resize(columns[k], nrows)
+                for k in columns:
+                    columns[k][n:n+m] = chunk[k]
+                n += m
+            for k in columns:
+                columns[k] = columns[k][:n]
         
+        self.timestamps = columns["timestamps"]
+        self.latitudes  = columns["latitudes"]
+        self.longitudes = columns["longitudes"]
+        self.elevations = columns["elevations"]
+        self.speeds     = columns["speeds"]
+        self.headings   = columns["headings"]
+        
+    def _decode(self, data, ftype, fmt=None):
+        """
+        Convert a DataFrame (or a chunk of it) to typed columns
+        """
+        columns = {}
         if ftype == 1:
-            self.elevations = np.array(data.altitude.tolist() )
-            self.speeds     = np.array(data.speed.tolist() )
+            columns["timestamps"] = parse_datetimes(data.local_date, data.local_time, fmt).astype(np.int64)
+            columns["elevations"] = data.altitude.values.astype(np.float64)
+            columns["speeds"]     = data.speed.values.astype(np.float64)
         else:
-            self.elevations = np.array( [float(elev[:-2]) for elev in data.height] )
-            self.speeds     = np.array( [float(speed[:-5]) for speed in data.speed] )
+            columns["timestamps"] = parse_datetimes(data["local date"], data["local time"], fmt).astype(np.int64)
+            columns["elevations"] = data.height.str[:-2].values.astype(np.float64)
+            columns["speeds"]     = data.speed.str[:-5].values.astype(np.float64)
+            
+        columns["latitudes"]  = self._parse_hemisphere(data.latitude, data.n_s, 'n', 's')
+        columns["longitudes"] = self._parse_hemisphere(data.longitude, data.e_w, 'e', 'w')
+        columns["headings"]   = data.heading.values.astype(np.float64)
         
-        self.headings   = np.array(data.heading.tolist() )
+        return columns
+    
+    def _count_rows(self, fname):
+        nlines = 0
+        with open(fname, 'rb') as fid:
+            for block in iter(lambda: fid.read(2**20), b''):
+                nlines += block.count(b'\n')
+        return max(nlines - 1, 1)
         
-        self.unordered_source = False
-        self._ensure_sorted()
-        self._ensure_no_duplicates()
+    def _columns(self):
+        return {"timestamps":       self.timestamps,
+                "latitudes":        self.latitudes,
+                "longitudes":       self.longitudes,
+                "elevations":       self.elevations,
+                "speeds":           self.speeds,
+                "headings":         self.headings,
+                "source_index":     self.source_index,
+                "conflicting_duplicates": self.conflicting_duplicates,
+                "unordered_source": np.array(self.unordered_source)}
         
-        self.is_valid   = np.ones_like(self.timestamps)
+    def _set_columns(self, columns):
+        self.timestamps       = columns["timestamps"]
+        self.latitudes        = columns["latitudes"]
+        self.longitudes       = columns["longitudes"]
+        self.elevations       = columns["elevations"]
+        self.speeds           = columns["speeds"]
+        self.headings         = columns["headings"]
+        self.source_index     = columns["source_index"]
+        self.conflicting_duplicates = columns["conflicting_duplicates"]
+        self.unordered_source = bool(columns["unordered_source"])
         
-        self.is_first_fix = np.zeros_like(self.timestamps)
-        self.is_first_fix[0] = 1
+    def _sort_and_remove_duplicates(self):
+        """
+        Sort the fixes by timestamp (stable) and drop fixes with a repeated timestamp,
+        keeping the first one in the source file.
         
-        self.is_last_fix = np.zeros_like(self.timestamps)
-        self.is_last_fix[-1] = 1
+        self.source_index maps each fix to its row in the source file.
+        self.conflicting_duplicates flags source rows that were dropped as duplicates
+        but whose coordinates or elevation differ from the fix that was kept.
+        """
+        nsource = self.timestamps.shape[0]
+        self.conflicting_duplicates = np.zeros(nsource, dtype=bool)
         
-    def _ensure_sorted(self):
-        jumps = np.where( np.diff(self.timestamps) < 0. )[0]
-        if jumps.shape[0] > 0:
+        if np.any( np.diff(self.timestamps) < 0 ):
             self.unordered_source = True
             print("Participant ", self.id, " has unsorted timestamps.")
-            self._sortme()
+            permutation = np.argsort(self.timestamps, kind='mergesort')
+        else:
+            permutation = np.arange(nsource)
             
-    def _sortme(self):
-        indexes = np.argsort(self.timestamps, 0)
-        self.timestamps = self.timestamps[indexes]
-        self.local_datetime = self.local_datetime[indexes]
-        self.latitudes  = self.latitudes[indexes]
-        self.longitudes = self.longitudes[indexes]
-        self.elevations = self.elevations[indexes]
-        self.speeds     = self.speeds[indexes]
-        self.headings   = self.headings[indexes]
-        
-    def _ensure_no_duplicates(self):
-        duplicates = np.where( np.diff(self.timestamps) == 0. )[0]
-        if duplicates.shape[0] > 0:
+        timestamps = self.timestamps[permutation]
+        is_duplicate = np.zeros(nsource, dtype=bool)
+        is_duplicate[1:] = np.diff(timestamps) == 0
+        
+        if np.any(is_duplicate):
             self.unordered_source = True
             print("Participant ", self.id, " has duplicated timestamps.")
-            self._remove_duplicates()
-            
-    def _remove_duplicates(self):
-        unique_timestamps = []
-        my_ldt      = []
-        my_lat      = []
-        my_lon      = []
-        my_elev     = []
-        my_speed    = []
-        my_headings = []
-        
-        current_timestamp = -1
-        
-        for i in np.arange(self.timestamps.shape[0]):
-            if current_timestamp == self.timestamps[i]:
-                assert np.isclose(my_lat[-1], self.latitudes[i])
-                assert np.isclose(my_lon[-1], self.longitudes[i])
-                assert np.isclose(my_elev[-1], self.elevations[i])
-            else:
-                unique_timestamps += [self.timestamps[i]]
-                my_ldt            += [self.local_datetime[i]]
-                my_lat            += [self.latitudes[i]]
-                my_lon            += [self.longitudes[i]]
-                my_elev           += [self.elevations[i]]
-                my_speed          += [self.speeds[i]]
-                my_headings       += [self.headings[i]]
-                current_timestamp = self.timestamps[i]
-                
-        self.timestamps = np.array(unique_timestamps)
-        self.local_datetime = np.array(my_ldt)
-        self.latitudes = np.array(my_lat)
-        self.longitudes = np.array(my_lon)
-        self.elevations = np.array(my_elev)
-        self.speeds     = np.array(my_speed)
-        self.headings   = np.array(my_headings)
+            kept  = permutation[ np.maximum.accumulate(np.where(is_duplicate, 0, np.arange(nsource))) ]
+            same_fix = np.isclose(self.latitudes[kept],  self.latitudes[permutation])  & \
+                       np.isclose(self.longitudes[kept], self.longitudes[permutation]) & \
+                       np.isclose(self.elevations[kept], self.elevations[permutation])
+            self.conflicting_duplicates[ permutation[is_duplicate & ~same_fix] ] = True
+            if np.any(self.conflicting_duplicates):
+                print("Participant ", self.id, " has", np.sum(self.conflicting_duplicates), 
+                      "duplicated timestamps with conflicting coordinates.")
+            permutation = permutation[~is_duplicate]
         
+        self.source_index = permutation
+        if self.unordered_source:
+            self.timestamps     = self.timestamps[permutation]
+            self.latitudes      = self.latitudes[permutation]
+            self.longitudes     = self.longitudes[permutation]
+            self.elevations     = self.elevations[permutation]
+            self.speeds         = self.speeds[permutation]
+            self.headings       = self.headings[permutation]
         
-        
-        
-    def _parselatitude(self, lat, n_s):
-        n_s = n_s.strip(" ")
-        if n_s.lower() not in ['n', 's']:
-            print("n_s", n_s)
+    def _parse_hemisphere(self, values, hemisphere, positive, negative):
+        """
+        Apply the hemisphere sign to a whole column of coordinates.
+        hemisphere is the column of N/S (or E/W) letters
+        """
+        hemisphere = hemisphere.str.strip(" ").str.lower().values
+        is_negative = hemisphere == negative
+        is_invalid  = np.logical_and(hemisphere != positive, np.logical_not(is_negative))
+        if np.any(is_invalid):
+            print(positive+"_"+negative, hemisphere[is_invalid][0], "at row", np.where(is_invalid)[0][0])
             raise ValueError()
         
-        if n_s.lower() == 's':
-            return -lat
-        else:
-            return lat
+        out = values.values.astype(np.float64)
+        out[is_negative] *= -1.
+        return out
         
-    def _parselongitude(self, lon, e_w):
-        e_w = e_w.strip(" ")
-        assert e_w.lower() in ['e', 'w']
-        if e_w.lower() == 'e':
-            return lon
-        else:
-            return -lon
+    def fix_distances(self):
+        """
+        Distances between fixes (see FixDistances)
+        """
+        if self._fix_distances is None:
+            self._fix_distances = FixDistances(self.latitudes, self.longitudes, self.g, self.proj)
+        return self._fix_distances
+        
+    def step_distances(self):
+        """
+        Distance (meters) between fix i-1 and fix i (0 for the first fix),
+        computed once and shared by the filter and the clean data
+        """
+        if self._step_distances is None:
+            self._step_distances = self.fix_distances().consecutive(pad=True)
+        return self._step_distances
         
     def _getFix(self, i):
         if i < self.timestamps.shape[0]:
@@ -202,7 +365,62 @@ class RawGPSData:
             print(*args)
         
     def filter(self, parameters):
-        g = GeodesicDistance()
+        """
+        Mark invalid fixes and first/last fixes of each segment (loss of signal).
+        parameters["engine"] selects the implementation:
+        - "vectorized": candidate masks on whole arrays plus a short sequential pass (default)
+        - "legacy": the original fix-by-fix loop
+        - "check": run both and assert that they agree
+        
+        The reason why each fix was rejected is stored in the int8 array rejection
+        (see REJECTION_REASONS). Returns the per-participant counts (see filter_stats).
+        """
+        engine = parameters["engine"]
+        if engine == "vectorized":
+            self._filter_vectorized(parameters)
+        elif engine == "legacy":
+            self._filter_legacy(parameters)
+        elif engine == "check":
+            self._filter_check(parameters)
+        else:
+            raise ValueError("Unknown filter engine {0}".format(engine))
+        
+        if parameters["rm_lone"]:
+            lone_points = (self.is_last_fix*self.is_first_fix)==1
+            self._log("Remove lone points: ", np.where(lone_points)[0])
+            self.rejection[ lone_points & (self.is_valid==1) ] = self.LONE
+            self.is_valid[ lone_points ] = 0
+            self.is_first_fix[lone_points] = 0
+            self.is_last_fix[lone_points] = 0
+            
+        if parameters["rm_sparse"]:
+            first_fixes = np.where(self.is_first_fix==1)[0]
+            last_fixes = np.where(self.is_last_fix==1)[0]
+            assert(first_fixes.shape[0] == last_fixes.shape[0] )
+            for i in np.arange(first_fixes.shape[0]):
+                if self.timestamps[last_fixes[i]] - self.timestamps[first_fixes[i]] <= 180:
+                    self._log("Remove sparse points: ", first_fixes[i], last_fixes[i])
+                    sparse = self.rejection[ first_fixes[i]:last_fixes[i]+1 ]
+                    sparse[ self.is_valid[ first_fixes[i]:last_fixes[i]+1 ]==1 ] = self.SPARSE
+                    self.is_valid[ first_fixes[i]:last_fixes[i]+1 ] = 0
+                    self.is_first_fix[first_fixes[i]:last_fixes[i]+1] = 0
+                    self.is_last_fix[first_fixes[i]:last_fixes[i]+1] = 0
+                    
+        return self.filter_stats()
+        
+    def filter_stats(self):
+        """
+        Number of valid fixes and of fixes rejected for each reason in REJECTION_REASONS
+        """
+        counts = np.bincount(self.rejection, minlength=len(self.REJECTION_REASONS))
+        out = {"partid": self.id, "total_fixes": self.timestamps.shape[0]}
+        for code, reason in enumerate(self.REJECTION_REASONS):
+            out[reason] = counts[code]
+        return out
+    
+    def _filter_legacy(self, parameters):
+        fd = self.fix_distances()
+        step_dist = self.step_distances()
         prev_fix = self._getFix(0)
         max_speed_ms = km_per_hour_to_meter_per_second(parameters["max_speed"])
         for i in np.arange(0, self.timestamps.shape[0]):
@@ -218,6 +436,7 @@ class RawGPSData:
                 
             if self.is_first_fix[i] and i == self.timestamps.shape[0]-1:
                 self.is_valid[i] = 0
+                self.rejection[i] = self.LAST_LONE
                 self.is_first_fix[i] = 0
                 continue
 
@@ -226,9 +445,9 @@ class RawGPSData:
                 # Let's do a check forward:
                 next_fix = self._getFix(i+1)
                 nnext_fix = self._getFix(i+2)
-                distance = g.compute_distance(*curr_fix.coords, *next_fix.coords)
+                distance = step_dist[i+1]
                 if nnext_fix:
-                    distance2 = g.compute_distance(*curr_fix.coords, *nnext_fix.coords)
+                    distance2 = fd.between(i, i+2)
                     dt2 = nnext_fix.tstmp - curr_fix.tstmp
                     d_elev2 = np.abs(curr_fix.elev - nnext_fix.elev)
                 else:
@@ -239,6 +458,7 @@ class RawGPSData:
                 if distance > parameters["max_dist"] and distance2 > parameters["max_dist"]:
                     self._log("First fix", i, "is invalid (max_dist)")
                     self.is_valid[i]       = 0
+                    self.rejection[i] = self.FIRST_MAX_DIST
                     self.is_first_fix[i]   = 0
                     self.is_first_fix[i+1] = 1
                     continue
@@ -249,6 +469,7 @@ class RawGPSData:
                 if speed > max_speed_ms and speed2 > max_speed_ms:
                     self._log("First fix", i, "is invalid (max_speed)")
                     self.is_valid[i] = 0
+                    self.rejection[i] = self.FIRST_MAX_SPEED
                     self.is_first_fix[i]   = 0
                     self.is_first_fix[i+1] = 1
                     continue
@@ -257,6 +478,7 @@ class RawGPSData:
                 if d_elev > parameters["max_d_elev"] and d_elev2 > parameters["max_d_elev"]:
                     self._log("First fix", i, "is invalid (max_d_elev)")
                     self.is_valid[i] = 0
+                    self.rejection[i] = self.FIRST_MAX_D_ELEV
                     self.is_first_fix[i]   = 0
                     self.is_first_fix[i+1] = 1
                     continue
@@ -270,10 +492,14 @@ class RawGPSData:
                 continue
             
             # If distance wrt previous fix is larger than max dist mark fix as invalid  
-            distance = g.compute_distance(*prev_fix.coords, *curr_fix.coords)
+            if prev_fix.index == i-1:
+                distance = step_dist[i]
+            else:
+                distance = fd.between(prev_fix.index, i)
             if distance > parameters["max_dist"]:
                 self._log("Fix", i, " was marked as invalid (max_dist)")
                 self.is_valid[i] = 0
+                self.rejection[i] = self.MAX_DIST
                 continue
             
             # If average speed wrt previos fix is larger than max speed mark fix as invalid
@@ -282,6 +508,7 @@ class RawGPSData:
             if speed > max_speed_ms:
                 self._log("Fix", i, " was marked as invalid (max_speed)")
                 self.is_valid[i] = 0
+                self.rejection[i] = self.MAX_SPEED
                 continue
             
             # If elevation change wrt previos fix is larger than max elevation change mark fix as invalid
@@ -289,6 +516,7 @@ class RawGPSData:
             if d_elev > parameters["max_d_elev"]:
                 self._log("Fix", i, " was marked as invalid (max_d_elev)")
                 self.is_valid[i] = 0
+                self.rejection[i] = self.MAX_D_ELEV
                 continue
             
             # If this is not the last fix
@@ -303,53 +531,229 @@ class RawGPSData:
                     self.is_first_fix[i+1] = 1
                 else:
                     #We did not lost signal, check 3 points distance
-                    dd_dist = g.compute_distance(*next_fix.coords, *prev_fix.coords)
+                    dd_dist = fd.between(i+1, prev_fix.index)
                     if distance > parameters["min_dist"] and dd_dist < parameters["min_dist"]:
                         self._log("Fix", i, " was marked as invalid (min_dist)")
                         self.is_valid[i] = 0
+                        self.rejection[i] = self.MIN_DIST
                         continue
                     
             # If I am here it means that the fix is valid, so we can move to the next
             prev_fix.assign(curr_fix)
-         
-        if parameters["rm_lone"]:
-            lone_points = (self.is_last_fix*self.is_first_fix)==1
-            self._log("Remove lone points: ", np.where(lone_points)[0])
-            self.is_valid[ lone_points ] = 0
-            self.is_first_fix[lone_points] = 0
-            self.is_last_fix[lone_points] = 0
             
-        if parameters["rm_sparse"]:
-            first_fixes = np.where(self.is_first_fix==1)[0]
-            last_fixes = np.where(self.is_last_fix==1)[0]
-            assert(first_fixes.shape[0] == last_fixes.shape[0] )
-            for i in np.arange(first_fixes.shape[0]):
-                if self.timestamps[last_fixes[i]] - self.timestamps[first_fixes[i]] <= 180:
-                    self._log("Remove sparse points: ", first_fixes[i], last_fixes[i])
-                    self.is_valid[ first_fixes[i]:last_fixes[i]+1 ] = 0
-                    self.is_first_fix[first_fixes[i]:last_fixes[i]+1] = 0
-                    self.is_last_fix[first_fixes[i]:last_fixes[i]+1] = 0
+    def _filter_vectorized(self, parameters):
+        """
+        Same classification as _filter_legacy.
+        All the tests are first evaluated on whole arrays assuming that the previous
+        valid fix of fix i is fix i-1. The sequential pass then only visits the fixes
+        where some test fails (or where the previous valid fix is not i-1), and jumps
+        over runs of clean fixes.
+        """
+        n = self.timestamps.shape[0]
+        fd = self.fix_distances()
+        max_dist   = parameters["max_dist"]
+        min_dist   = parameters["min_dist"]
+        max_d_elev = parameters["max_d_elev"]
+        max_sloss  = parameters["max_sloss"]
+        max_speed_ms = km_per_hour_to_meter_per_second(parameters["max_speed"])
+        
+        t    = self.timestamps
+        elev = self.elevations.astype(np.float64)
+        
+        # Backward quantities w.r.t. fix i-1 and skip quantities w.r.t. fix i-1 and fix i+1
+        step  = self.step_distances()
+        skip  = np.full(n, np.inf)
+        dt    = np.ones(n, dtype=np.int64)
+        dt2   = np.ones(n, dtype=np.int64)
+        delev = np.full(n, np.inf)
+        delev2 = np.full(n, np.inf)
+        if n > 1:
+            dt[1:]    = np.diff(t)
+            delev[1:] = np.abs(np.diff(elev))
+        if n > 2:
+            skip[1:-1]   = fd.between(np.arange(0, n-2), np.arange(2, n))
+            dt2[1:-1]    = t[2:] - t[:-2]
+            delev2[1:-1] = np.abs(elev[2:] - elev[:-2])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed  = step/dt
+            speed2 = skip/dt2
+        
+        sloss_bwd = dt > max_sloss
+        # Reason why fix i is invalid w.r.t. fix i-1 (tests in the legacy order)
+        bwd_code  = np.select([step > max_dist, speed > max_speed_ms, delev > max_d_elev],
+                              [self.MAX_DIST, self.MAX_SPEED, self.MAX_D_ELEV], self.VALID).astype(np.int8)
+        bad_bwd   = bwd_code != self.VALID
+        sloss_fwd = np.zeros(n, dtype=bool)
+        spike     = np.zeros(n, dtype=bool)
+        sloss_fwd[:-1] = sloss_bwd[1:]
+        spike[:-1] = (step[:-1] > min_dist) & (skip[:-1] < min_dist) & ~sloss_fwd[:-1]
+        
+        # First fix i: invalid if both fix i+1 and fix i+2 disagree with it
+        first_code = np.full(n, self.VALID, dtype=np.int8)
+        first_code[:-1] = np.select([(step[1:] > max_dist) & (skip[1:] > max_dist),
+                                     (speed[1:] > max_speed_ms) & (speed2[1:] > max_speed_ms),
+                                     (delev[1:] > max_d_elev) & (delev2[1:] > max_d_elev)],
+                                    [self.FIRST_MAX_DIST, self.FIRST_MAX_SPEED, self.FIRST_MAX_D_ELEV], self.VALID)
+        
+        clean = ~(sloss_bwd | bad_bwd | sloss_fwd | spike)
+        clean[self.is_first_fix == 1] = False
+        # next_event[i]: first fix j >= i which is not clean
+        next_event = np.where(clean, n, np.arange(n))
+        next_event = np.minimum.accumulate(next_event[::-1])[::-1]
+        
+        is_valid   = self.is_valid.tolist()
+        is_first   = self.is_first_fix.tolist()
+        is_last    = self.is_last_fix.tolist()
+        rejection  = self.rejection.tolist()
+        t          = t.tolist()
+        elev       = elev.tolist()
+        bwd_code   = bwd_code.tolist()
+        sloss_fwd  = sloss_fwd.tolist()
+        spike      = spike.tolist()
+        first_code = first_code.tolist()
+        clean      = clean.tolist()
+        next_event = next_event.tolist()
+        
+        p = 0
+        i = 0
+        while i < n:
+            if t[i] - t[p] > max_sloss:
+                self._log("Fix", i, "Previous fix", p, "Mark it as first fix")
+                is_first[i] = 1
+                is_last[p]  = 1
+            
+            if is_first[i]:
+                if i == n-1:
+                    is_valid[i] = 0
+                    rejection[i] = self.LAST_LONE
+                    is_first[i] = 0
+                elif first_code[i]:
+                    self._log("First fix", i, "is invalid")
+                    is_valid[i]   = 0
+                    rejection[i]  = first_code[i]
+                    is_first[i]   = 0
+                    is_first[i+1] = 1
+                else:
+                    if sloss_fwd[i]:
+                        self._log("Fix", i, "is a lone fix")
+                        is_last[i]    = 1
+                        is_first[i+1] = 1
+                    p = i
+                i += 1
+                continue
             
+            if p == i-1:
+                if clean[i]:
+                    # Jump to the next fix that fails some test
+                    i = next_event[i]
+                    p = i-1
+                    continue
+                if bwd_code[i]:
+                    self._log("Fix", i, " was marked as invalid")
+                    is_valid[i] = 0
+                    rejection[i] = bwd_code[i]
+                    i += 1
+                    continue
+                if sloss_fwd[i]:
+                    self._log("Fix", i, " was marked as last fix")
+                    is_last[i]    = 1
+                    is_first[i+1] = 1
+                elif spike[i]:
+                    self._log("Fix", i, " was marked as invalid (min_dist)")
+                    is_valid[i] = 0
+                    rejection[i] = self.MIN_DIST
+                    i += 1
+                    continue
+                p = i
+                i += 1
+                continue
+            
+            # The previous valid fix is not i-1: evaluate the tests against fix p
+            distance = fd.between(p, i)
+            if distance > max_dist:
+                code = self.MAX_DIST
+            elif distance/(t[i] - t[p]) > max_speed_ms:
+                code = self.MAX_SPEED
+            elif abs(elev[i] - elev[p]) > max_d_elev:
+                code = self.MAX_D_ELEV
+            else:
+                code = self.VALID
+            if code:
+                self._log("Fix", i, " was marked as invalid")
+                is_valid[i] = 0
+                rejection[i] = code
+                i += 1
+                continue
+            if i < n-1:
+                if sloss_fwd[i]:
+                    self._log("Fix", i, " was marked as last fix")
+                    is_last[i]    = 1
+                    is_first[i+1] = 1
+                elif distance > min_dist and fd.between(i+1, p) < min_dist:
+                    self._log("Fix", i, " was marked as invalid (min_dist)")
+                    is_valid[i] = 0
+                    rejection[i] = self.MIN_DIST
+                    i += 1
+                    continue
+            p = i
+            i += 1
+        
+        self.is_valid[:]     = is_valid
+        self.is_first_fix[:] = is_first
+        self.is_last_fix[:]  = is_last
+        self.rejection[:]    = rejection
+        
+    def _filter_check(self, parameters):
+        """
+        Run the legacy and the vectorized engine and check that they produce the same flags.
+        """
+        names = ["is_valid", "is_first_fix", "is_last_fix", "rejection"]
+        flags = [getattr(self, name).copy() for name in names]
+        self._filter_legacy(parameters)
+        legacy = [getattr(self, name).copy() for name in names]
+        for name, a in zip(names, flags):
+            setattr(self, name, a)
+        self._filter_vectorized(parameters)
+        for name, a in zip(names, legacy):
+            b = getattr(self, name)
+            mismatch = np.where(a != b)[0]
+            assert mismatch.shape[0] == 0, \
+                "Participant {0}: filter engines disagree on {1} at fixes {2}".format(self.id, name, mismatch[:10])
+        
     def getCleanData(self, filter_parameters):
         self.filter(filter_parameters)
-        out = GPSData(self.id, self.fname)
+        out = GPSData(self.id, self.fname, proj=self.proj, distance=self.g)
         out.unordered_source = self.unordered_source
         out.timestamps = self.timestamps[self.is_valid==1]
-        out.local_datetime = self.local_datetime[self.is_valid==1]
         out.latitudes  = self.latitudes[self.is_valid==1 ]
         out.longitudes = self.longitudes[self.is_valid==1]
         out.elevations = self.elevations[self.is_valid==1]
         out.is_first_fix = self.is_first_fix[self.is_valid==1 ]
         out.is_last_fix  = self.is_last_fix[self.is_valid==1 ]
-        out.is_valid     = np.ones_like(out.timestamps)
+        out.is_valid     = np.ones(out.timestamps.shape[0], dtype=np.uint8)
         
         out.is_first_fix[0] = 1
         out.is_last_fix[-1] = 1
         
         out.valid_fixes_id = np.arange(self.timestamps.shape[0])[self.is_valid==1]
+        out.source_index   = self.source_index[self.is_valid==1]
         out.ntotal_fixes = self.timestamps.shape[0]
         
         out.logging = self.logging
+        
+        fd = self.fix_distances()
+        if self.proj is not None:
+            out.xy = (fd.x[self.is_valid==1], fd.y[self.is_valid==1])
+        
+        # Reuse the distances computed by the filter for fixes that were consecutive in the raw data
+        valid_fixes_id = out.valid_fixes_id
+        step_dist = np.zeros(valid_fixes_id.shape[0])
+        consecutive = np.diff(valid_fixes_id) == 1
+        step_dist[1:][consecutive] = self.step_distances()[ valid_fixes_id[1:][consecutive] ]
+        others = np.where(~consecutive)[0] + 1
+        step_dist[others] = fd.between(valid_fixes_id[others-1], valid_fixes_id[others])
+        out._derived["step_distances"] = step_dist
+        
         out.compute_dist()
         
         return out
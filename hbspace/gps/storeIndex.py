@@ -0,0 +1,84 @@
+# 
+# This file is part of the Health Behavior in Space software (https://github.com/dsalvolab/hbspace).
+# Copyright (c) 2022 Umberto Villa.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import numpy as np
+
+from .gridIndex import GridCells, degrees_within, expand_ranges
+
+class StoreIndex:
+    """
+    Uniform grid (in degrees) over the stores of a store dictionary
+    (store_id -> (latitude, longitude, marker), see storeAddresses).
+    Build it once and pass it to GPSData.mark_store for all the participants.
+    """
+    def __init__(self, store_maps_coords, cell=5e-4):
+        self.store_maps_coords = store_maps_coords
+        self.grid = GridCells(cell)
+        
+        ids    = np.array(list(store_maps_coords.keys()), dtype=np.int64)
+        coords = np.array([(v[0], v[1], v[2]) for v in store_maps_coords.values()], dtype=np.float64).reshape(-1, 3)
+        finite = np.isfinite(coords[:,0]) & np.isfinite(coords[:,1])
+        rank   = np.arange(ids.shape[0])[finite]
+        
+        keys  = self.grid.keys(coords[finite,0], coords[finite,1])
+        order = np.argsort(keys, kind="stable")
+        self.keys    = keys[order]
+        self.rank    = rank[order]    # Position of the store in store_maps_coords (for ties)
+        self.ids     = ids[finite][order]
+        self.lats    = coords[finite,0][order]
+        self.lons    = coords[finite,1][order]
+        self.markers = coords[finite,2][order].astype(np.int8)
+        
+    def nearest(self, lats, lons, radius):
+        """
+        For each point, position (in the sorted arrays of the index) of the nearest store
+        in the (latitude, longitude) plane, or -1 if no store can be within radius meters.
+        As in a linear scan of store_maps_coords, ties go to the first store.
+        """
+        n = lats.shape[0]
+        out = -np.ones(n, dtype=np.int64)
+        if n == 0 or self.keys.shape[0] == 0:
+            return out
+        
+        # Largest distance in degrees of a store within radius meters (10% margin)
+        max_d = degrees_within(radius, np.max(np.abs(lats)) + 1.)
+        r = int(np.ceil(max_d/self.grid.cell))
+        
+        ci, cj = self.grid.cells(lats, lons)
+        point  = []
+        store  = []
+        for di in range(-r, r+1):
+            for dj in range(-r, r+1):
+                keys = self.grid.key(ci + di, cj + dj)
+                lo = np.searchsorted(self.keys, keys, side="left")
+                hi = np.searchsorted(self.keys, keys, side="right")
+                p, s, _, _ = expand_ranges(lo, hi)
+                point.append(p)
+                store.append(s)
+        point = np.concatenate(point)
+        store = np.concatenate(store)
+        
+        d2 = (lats[point] - self.lats[store])**2 + (lons[point] - self.lons[store])**2
+        close = d2 <= max_d**2
+        point, store, d2 = point[close], store[close], d2[close]
+        
+        order = np.lexsort((self.rank[store], d2, point))
+        point, store = point[order], store[order]
+        first = np.concatenate(([True], point[1:] != point[:-1])) if point.shape[0] else np.zeros(0, dtype=bool)
+        out[point[first]] = store[first]
+        return out
@@ -0,0 +1,178 @@
+# 
+# This file is part of the Health Behavior in Space software (https://github.com/dsalvolab/hbspace).
+# Copyright (c) 2022 Umberto Villa.
+# 
+# This program is free software: you can redistribute it and/or modify  
+# it under the terms of the GNU General Public License as published by  
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but 
+# WITHOUT ANY WARRANTY; without even the implied warranty of 
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU 
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License 
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import numpy as np
+
+class Column:
+    """
+    Attribute of a view (Trip, Visit, Location) stored in a column of its table.
+    none and empty are the sentinel values used to store None and "" in a numeric column.
+    If boolean is True, the value is returned as a python bool.
+    """
+    def __init__(self, dtype, none=None, empty=None, boolean=False):
+        self.dtype   = dtype
+        self.none    = none
+        self.empty   = empty
+        self.boolean = boolean
+        self.name    = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def default(self):
+        if self.none is not None:
+            return self.none
+        return 0
+
+    def __get__(self, view, owner=None):
+        if view is None:
+            return self
+        v = view._table.columns[self.name][view._row]
+        if self.none is not None and (v == self.none or (v != v and self.none != self.none)):
+            return None
+        if self.empty is not None and v == self.empty:
+            return ""
+        if self.boolean:
+            return bool(v)
+        return v
+
+    def __set__(self, view, value):
+        if value is None:
+            assert self.none is not None, "Column {0} cannot be None".format(self.name)
+            value = self.none
+        elif isinstance(value, str) and value == "":
+            assert self.empty is not None, "Column {0} cannot be empty".format(self.name)
+            value = self.empty
+        view._table.columns[self.name][view._row] = value
+
+
+class EntityTable:
+    """
+    Struct-of-arrays storage for entities (trips, visits, locations).
+    The columns are the Column attributes of the VIEW class; indexing or iterating
+    the table returns views, so the table can be used as a list of VIEW objects.
+    """
+    VIEW = None
+
+    def __init__(self, capacity=16):
+        self.size = 0
+        self.columns = {}
+        for name, col in self.column_specs():
+            self.columns[name] = np.full(capacity, col.default(), dtype=col.dtype)
+
+    @classmethod
+    def column_specs(cls):
+        return [(name, col) for name, col in vars(cls.VIEW).items() if isinstance(col, Column)]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if i < 0 or i >= self.size:
+            raise IndexError(i)
+        return self.VIEW._view(self, i)
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self.VIEW._view(self, i)
+
+    def column(self, name):
+        """
+        Column name of the table (numpy array, without the sentinel conversions of the views)
+        """
+        return self.columns[name][:self.size]
+
+    def find(self, id):
+        """
+        View of the row with the given id
+        """
+        rows = np.where(self.column("id") == id)[0]
+        if rows.shape[0] == 0:
+            raise KeyError(id)
+        return self[rows[0]]
+
+    def _reserve(self, n):
+        capacity = next(iter(self.columns.values())).shape[0]
+        if self.size + n > capacity:
+            capacity = max(2*capacity, self.size + n, 16)
+            for name, col in self.column_specs():
+                grown = np.full(capacity, col.default(), dtype=col.dtype)
+                grown[:self.size] = self.columns[name][:self.size]
+                self.columns[name] = grown
+
+    def new_row(self):
+        """
+        Append a row with default values and return its index
+        """
+        self._reserve(1)
+        self.size += 1
+        return self.size - 1
+
+    def extend(self, **values):
+        """
+        Append one row per entry of the arrays in values (column name -> array).
+        Missing columns get their default value.
+        """
+        n = len(next(iter(values.values())))
+        self._reserve(n)
+        for name, v in values.items():
+            self.columns[name][self.size:self.size+n] = v
+        self.size += n
+
+    def append(self, view):
+        """
+        Copy the row of view in this table, and make view a view of the new row
+        """
+        row = self.new_row()
+        for name in self.columns:
+            self.columns[name][row] = view._table.columns[name][view._row]
+        view._table = self
+        view._row   = row
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        Concatenate tables (e.g. of different participants) in a new table
+        """
+        out = cls.__new__(cls)
+        out.size = sum(len(t) for t in tables)
+        out.columns = {}
+        for name, col in cls.column_specs():
+            out.columns[name] = np.concatenate([t.column(name) for t in tables]).astype(col.dtype, copy=False)
+        return out
+
+
+class EntityView:
+    """
+    Base class of the views over a row of an EntityTable.
+    A view created with the class constructor owns a private one-row table.
+    """
+    TABLE = None
+
+    def _init_row(self):
+        self._table = self.TABLE(1)
+        self._row   = self._table.new_row()
+
+    @classmethod
+    def _view(cls, table, row):
+        out = cls.__new__(cls)
+        out._table = table
+        out._row   = row
+        return out
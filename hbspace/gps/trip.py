@@ -15,10 +15,36 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import numpy as np
+from .tables import Column, EntityTable, EntityView
+
 trip_mode = {-1: "unknown", 0: "slow_walk", 1: "walk", 2: "bike", 3: "vehicle"}
+trip_mode_code = {v: k for k, v in trip_mode.items()}
 
-class Trip:
+class Trip(EntityView):
+    """
+    A trip, stored as a row of a TripTable
+    """
+    id          = Column(np.int32, none=-1)
+    start_index = Column(np.int64, none=-1)
+    end_index   = Column(np.int64, none=-1)
+    duration    = Column(np.float64, none=np.nan)
+    distance    = Column(np.float64, none=np.nan)
+    is_valid    = Column(np.int8, none=-1, boolean=True)
+    radius      = Column(np.float64, none=np.nan)
+    crowdist    = Column(np.float64, none=np.nan)
+    speedRMax   = Column(np.float64, none=np.nan)
+    speedAvg    = Column(np.float64, none=np.nan)
+    type_code   = Column(np.int8, none=-2)
+    speedP50    = Column(np.float64, none=np.nan)
+    speedP85    = Column(np.float64, none=np.nan)
+    speedP95    = Column(np.float64, none=np.nan)
+    fracAboveWalk    = Column(np.float64, none=np.nan)
+    fracAboveBike    = Column(np.float64, none=np.nan)
+    fracAboveVehicle = Column(np.float64, none=np.nan)
+    
     def __init__(self, id=None, start_index=None, end_index=None, duration=None, distance=None, isValid=None):
+        self._init_row()
         self.id = id
         self.start_index = start_index
         self.end_index = end_index
@@ -26,12 +52,14 @@ class Trip:
         self.distance = distance
         self.is_valid = isValid
         
-        self.radius   = None
-        self.crowdist = None
-        self.speedRMax = None
-        self.speedAvg = None
-        
-        self.type = None
+    @property
+    def type(self):
+        code = self.type_code
+        return None if code is None else trip_mode[code]
+    
+    @type.setter
+    def type(self, value):
+        self.type_code = None if value is None else trip_mode_code[value]
         
     def classify(self, parameters):
         if self.speedAvg < parameters["walk"][0] and self.speedRMax < parameters["walk"][1]:
@@ -78,12 +106,12 @@ class Trip:
         out["tripid"] = self.id+1
         out['trip_is_valid'] = self.is_valid
         
-        out["trip_start_date"]      = data.local_datetime[self.start_index].strftime('%Y-%m-%d')
-        out["trip_start_time"]      = data.local_datetime[self.start_index].strftime('%H:%M:%S')
+        out["trip_start_date"]      = data.local_date(self.start_index)
+        out["trip_start_time"]      = data.local_time(self.start_index)
         out["trip_start_lat"]       = data.latitudes[self.start_index]
         out["trip_start_lon"]       = data.longitudes[self.start_index]
-        out["trip_end_date"]        = data.local_datetime[self.end_index].strftime('%Y-%m-%d')
-        out["trip_end_time"]        = data.local_datetime[self.end_index].strftime('%H:%M:%S')
+        out["trip_end_date"]        = data.local_date(self.end_index)
+        out["trip_end_time"]        = data.local_time(self.end_index)
         out["trip_end_lat"]         = data.latitudes[self.end_index]
         out["trip_end_lon"]         = data.longitudes[self.end_index]
         out["trip_duration"]        = self.duration/60.0      #Minutes
@@ -92,6 +120,12 @@ class Trip:
         out["trip_max_speed"]       = self.speedRMax           #Km/h
         out["trip_average_speed"]   = self.speedAvg           #Km/h
         out["trip_type"]            = self.type
+        out["trip_speed_p50"]       = self.speedP50           #Km/h
+        out["trip_speed_p85"]       = self.speedP85           #Km/h
+        out["trip_speed_p95"]       = self.speedP95           #Km/h
+        out["trip_frac_above_walk"]    = self.fracAboveWalk
+        out["trip_frac_above_bike"]    = self.fracAboveBike
+        out["trip_frac_above_vehicle"] = self.fracAboveVehicle
         
         if data.is_home is not None:
             out["is_trip_start_home"] = self.departedHome(data)
@@ -104,6 +138,12 @@ class Trip:
             if data.store_id[self.end_index] > -1:
                 out["trip_end_store_id"] = data.store_id[self.end_index]
                 out["is_fresh_trip_end"]  = data.store_marker[self.end_index]
+                
+        for name, place in data.geofences.items():
+            if place[self.start_index] > -1:
+                out["trip_start_"+name+"_id"] = place[self.start_index]
+            if place[self.end_index] > -1:
+                out["trip_end_"+name+"_id"] = place[self.end_index]
             
         
         return out
@@ -127,12 +167,21 @@ class Trip:
                 "trip_dist_crowflight",   #Crowflight distance between origin and destistantion (Km)
                 "trip_max_speed",         # Robust max speed (km/h)
                 "trip_average_speed",     # Average speed
-                "trip_type"               # Trip type: Walk, Bike, Vehicle
+                "trip_type",              # Trip type: Walk, Bike, Vehicle
+                "trip_speed_p50",         # Median speed (km/h)
+                "trip_speed_p85",         # 85th percentile speed (km/h)
+                "trip_speed_p95",         # 95th percentile speed (km/h)
+                "trip_frac_above_walk",   # Fraction of time above the walk mean speed cutoff
+                "trip_frac_above_bike",   # Fraction of time above the bike mean speed cutoff
+                "trip_frac_above_vehicle" # Fraction of time above the vehicle mean speed cutoff
                 ]
         
     @classmethod
-    def infoKeysExt(self):
-        return [
+    def infoKeysExt(self, geofences=()):
+        """
+        geofences: names of the geofence layers (see GPSData.mark_geofences)
+        """
+        out = [
                 "partid",                 #Participant ID
                 "tripid",                 #Trip ID
                 "trip_is_valid",
@@ -155,5 +204,36 @@ class Trip:
                 "trip_dist_crowflight",   #Crowflight distance between origin and destistantion (Km)
                 "trip_max_speed",         # Robust max speed (km/h)
                 "trip_average_speed",     # Average speed
-                "trip_type"               # Trip type: Walk, Bike, Vehicle
-                ]
\ No newline at end of file
+                "trip_type",              # Trip type: Walk, Bike, Vehicle
+                "trip_speed_p50",         # Median speed (km/h)
+                "trip_speed_p85",         # 85th percentile speed (km/h)
+                "trip_speed_p95",         # 95th percentile speed (km/h)
+                "trip_frac_above_walk",   # Fraction of time above the walk mean speed cutoff
+                "trip_frac_above_bike",   # Fraction of time above the bike mean speed cutoff
+                "trip_frac_above_vehicle" # Fraction of time above the vehicle mean speed cutoff
+                ]
+        for name in geofences:
+            out.append("trip_start_"+name+"_id")  # If trip starts in a place of the layer report its ID
+            out.append("trip_end_"+name+"_id")    # If trip ends in a place of the layer report its ID
+        return out
+
+
+class TripTable(EntityTable):
+    """
+    Columns of all the trips of a participant (or of a cohort, see concatenate)
+    """
+    VIEW = Trip
+    
+    def classify(self, parameters, features=("speedAvg", "speedRMax")):
+        """
+        Same as Trip.classify for all the trips at once; features are the columns
+        compared with the (mean, max) cutoffs of each mode
+        """
+        speedAvg  = self.column(features[0])
+        speedRMax = self.column(features[1])
+        conditions = [(speedAvg < parameters[mode][0]) & (speedRMax < parameters[mode][1])
+                      for mode in ["walk", "bike", "vehicle"]]
+        self.column("type_code")[:] = np.select(conditions, [trip_mode_code[mode] for mode in ["walk", "bike", "vehicle"]],
+                                                trip_mode_code["unknown"])
+    
+Trip.TABLE = TripTable
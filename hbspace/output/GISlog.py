@@ -19,7 +19,6 @@ import os
 import csv
 import numpy as np
 from ..gps.trip import trip_mode
-import datetime
 
 def GISlog_writer(gpsData, fname_in, folder_out):
     if gpsData.unordered_source:
@@ -33,11 +32,11 @@ def GISlog_writer_ordered(gpsData, fname_in, folder_out):
     
     data = []
     
-    with open(fname_in, "rU") as fid:
+    with open(fname_in, "r") as fid:
         reader = csv.DictReader(fid)
         counter = 0
         valid_counter = 0
-        is_valid = np.zeros(gpsData.ntotal_fixes, dtype=np.int)
+        is_valid = np.zeros(gpsData.ntotal_fixes, dtype=np.uint8)
         valid_fixes_id = gpsData.valid_fixes_id[gpsData.is_valid==1]
         is_valid[valid_fixes_id] = 1
         
@@ -107,36 +106,14 @@ def GISlog_writer_ordered(gpsData, fname_in, folder_out):
         for d in data:
             writer.writerow(d)
             
-def get_datetime_std(datestr, timestr):
-    datetime_str = datestr + " " + timestr
-    
-    formats = ("%Y/%m/%d %H:%M:%S", "%m/%d/%Y %H:%M:%S", "%m/%d/%y %H:%M:%S")
-    
-    for f in formats:
-        try:
-            return datetime.datetime.strptime(datetime_str,f).strftime("%Y-%m-%d %H:%M:%S")
-            break
-        except:
-            pass
-        
-    raise
-            
 def GISlog_writer_unordered(gpsData, fname_in, folder_out):
     fname_out = os.path.join( folder_out, os.path.basename(fname_in) )
     
-    data = {}
-    
-    with open(fname_in, "rU") as fid:
+    with open(fname_in, "r") as fid:
         reader = csv.DictReader(fid)
-                
-        for row in reader:
-            if "LOCAL_DATE" in row.keys():
-                date_num =get_datetime_std(row["LOCAL_DATE"], row["LOCAL_TIME"])
-            else:
-                date_num = get_datetime_std(row["LOCAL DATE"], row["LOCAL TIME"])
-            if date_num not in data.keys():
-                data[date_num] = row
+        data = [row for row in reader]
     
+    row = data[-1]
     row["State"] = ""
     row["Trip_ID"] = ""
     row["Location_ID"] = ""
@@ -149,16 +126,14 @@ def GISlog_writer_unordered(gpsData, fname_in, folder_out):
         row["StoreId"] = ""
         row["IsFreshStore"] = ""
          
-    keywords = row.keys()    
+    keywords = row.keys()
     with open(fname_out, "w", newline='') as fid:
         writer = csv.DictWriter(fid, keywords)
         writer.writeheader()
         for gps_counter in np.arange(gpsData.timestamps.shape[0]):
             if gpsData.is_valid[gps_counter]==0:
                 continue
-            key = gpsData.local_datetime[gps_counter].strftime("%Y-%m-%d %H:%M:%S")
-                            
-            row = data[key]
+            row = data[gpsData.source_index[gps_counter]]
             row["State"] = gpsData.state[gps_counter]
             row["Trip_ID"] = ""
             row["Location_ID"] = ""
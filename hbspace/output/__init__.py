@@ -17,6 +17,6 @@
 
 from .GISlog import GISlog_writer
 
-from .stats import trip_stats_headers, trip_stats
+from .stats import trip_stats_headers, trip_stats, filter_stats_headers
 
 from .visualization import *
\ No newline at end of file
@@ -16,8 +16,13 @@
 #
 
 import numpy as np
+from ..gps.rawGpsData import RawGPSData
+from ..gps.trip import trip_mode_code
 
-def trip_stats_headers():
+def filter_stats_headers():
+    return ["partid", "total_fixes"] + RawGPSData.REJECTION_REASONS
+
+def trip_stats_headers(geofences=()):
     out = ["partid",                 # PARTICIPANT ID
            "start_date",             # FIRST DAY OF DATA COLLECTION
            "start_time",             # TIME WHEN DATA COLLECTION STARTED
@@ -79,15 +84,18 @@ def trip_stats_headers():
         out.append("p75_"+type+"_trip_duration")
         out.append("p75_"+type+"_trip_distance")
         out.append("p75_"+type+"_trip_crowdist")
+        
+    for name in geofences:
+        out.append("tot_visits_to_"+name)     # Total number of visits to places of the geofence layer
     return out
 
 def trip_stats(data):
     out = {}
     out["partid"]     = data.id
-    out["start_date"] = data.local_datetime[0].strftime('%Y-%m-%d')
-    out["start_time"] = data.local_datetime[0].strftime('%H:%M:%S')
-    out["end_date"]   = data.local_datetime[-1].strftime('%Y-%m-%d')
-    out["end_time"]   = data.local_datetime[-1].strftime('%H:%M:%S')
+    out["start_date"] = data.local_date(0)
+    out["start_time"] = data.local_time(0)
+    out["end_date"]   = data.local_date(-1)
+    out["end_time"]   = data.local_time(-1)
     tot_hours, valid_hours, sloss_hours = data.measurement_time()
     out["number_of_days"] = np.ceil( tot_hours/24. )
     out["total_hours"] = tot_hours
@@ -96,13 +104,18 @@ def trip_stats(data):
         
     out["tot_number_of_trips"] = len(data.trips)
     
-    valid_trips = [trip for trip in data.trips if trip.is_valid]
+    valid_trips = data.trips.column("is_valid") == 1
+    
+    out["tot_number_of_valid_trips"] = np.sum(valid_trips)
     
-    out["tot_number_of_valid_trips"] = len(valid_trips)
+    all_durations = data.trips.column("duration")/60.
+    all_distances = data.trips.column("distance")*1.e-3
+    all_crowdists = data.trips.column("crowdist")*1.e-3
+    type_code     = data.trips.column("type_code")
     
-    durations = [trip.duration/60.   for trip in valid_trips]
-    distances = [trip.distance*1.e-3 for trip in valid_trips]
-    crowdists = [trip.crowdist*1.e-3 for trip in valid_trips]
+    durations = all_durations[valid_trips]
+    distances = all_distances[valid_trips]
+    crowdists = all_crowdists[valid_trips]
     
     out["average_trip_duration"] = np.mean(durations)
     out["average_trip_distance"] = np.mean(distances)
@@ -132,13 +145,13 @@ def trip_stats(data):
     out["p75_trip_crowdist"] = crowdist_percentiles[2]
         
     for type in ["walk", "bike", "vehicle"]:
-        trips = [trip for trip in valid_trips if trip.type == type]
-        ntrips = len(trips)
+        trips = valid_trips & (type_code == trip_mode_code[type])
+        ntrips = np.sum(trips)
         out["tot_number_of_"+type+"_trips"]   = ntrips
         if ntrips > 0:
-            durations = [trip.duration/60. for trip in trips]
-            distances = [trip.distance*1.e-3 for trip in trips]
-            crowdists = [trip.crowdist*1.e-3 for trip in trips]
+            durations = all_durations[trips]
+            distances = all_distances[trips]
+            crowdists = all_crowdists[trips]
             
             out["average_"+type+"_trip_duration"] = np.mean(durations)
             out["average_"+type+"_trip_distance"] = np.mean(distances)
@@ -167,26 +180,19 @@ def trip_stats(data):
             out["p75_"+type+"_trip_distance"] = distance_percentiles[2]
             out["p75_"+type+"_trip_crowdist"] = crowdist_percentiles[2]
             
-    tot_visits_to_store = 0
-    tot_visits_to_fresh_store = 0
-    for v in data.visits:
-        if v.store_id not in [None, ""]:
-            tot_visits_to_store+=1
-        if v.store_marker == 1:
-            tot_visits_to_fresh_store += 1
-            
-    out["tot_visits_to_store"] = tot_visits_to_store
-    out["tot_visits_to_fresh_store"] = tot_visits_to_fresh_store
+    out["tot_visits_to_store"] = np.sum(data.visits.column("store_id") >= 0)
+    out["tot_visits_to_fresh_store"] = np.sum(data.visits.column("store_marker") == 1)
+    for name, place in data.visits.geofences.items():
+        out["tot_visits_to_"+name] = np.sum(place >= 0)
     
-    tot_trips_originated_from_home = 0
-    tot_trips_arrived_at_home      = 0
-    for t in trips:
-        if t.departedHome(data) == 1:
-            tot_trips_originated_from_home += 1
-        if t.arrivedHome(data) == 1:
-            tot_trips_arrived_at_home += 1
-            
-    out["tot_trips_originated_from_home"] = tot_trips_originated_from_home
-    out["tot_trips_arrived_at_home"] = tot_trips_arrived_at_home
+    # Trips of the last type in the loop above
+    start_index = data.trips.column("start_index")[trips]
+    end_index   = data.trips.column("end_index")[trips]
+    if data.is_home is not None:
+        out["tot_trips_originated_from_home"] = np.sum( (data.is_first_fix[start_index] == 0) & (data.is_home[start_index] == 1) )
+        out["tot_trips_arrived_at_home"]      = np.sum( (data.is_last_fix[end_index] == 0) & (data.is_home[end_index] == 1) )
+    else:
+        out["tot_trips_originated_from_home"] = 0
+        out["tot_trips_arrived_at_home"]      = 0
             
     return out
\ No newline at end of file
@@ -21,7 +21,7 @@ def plot_map_by_trip(data, plt):
     """
     plt matplotlib object
     """
-    x,y = data.proj.get_xys(data.latitudes, data.longitudes)
+    x,y = data.get_xys()
     x = x*1e-3
     y = y*1e-3
     x = x[data.trip_marker >= 0]
@@ -39,7 +39,7 @@ def plot_map_by_trip(data, plt):
     plt.ylabel("Northings (Km)")  
     
 def plt_locations(data,plt):
-    x,y = data.proj.get_xys(data.latitudes, data.longitudes)   
+    x,y = data.get_xys()   
     x = x*1e-3
     y = y*1e-3
     x = x[data.trip_marker < 0]